@@ -3,9 +3,24 @@ A KBase module: ThermoStoichWizard
 */
 
 module ThermoStoichWizard {
+    /*
+        wall_time, cpu_time - seconds
+        peak_rss_delta - increase of the peak resident memory in MB
+    */
+    typedef structure {
+        string stage;
+        float wall_time;
+        float cpu_time;
+        float peak_rss_delta;
+    } StageTiming;
+
+    /*
+        performance - wall time, CPU time and peak memory of each stage of the method
+    */
     typedef structure {
         string report_name;
         string report_ref;
+        list<StageTiming> performance;
     } ReportResults;
 
     /*
@@ -16,12 +31,42 @@ module ThermoStoichWizard {
     /* An X/Y/Z style reference */
     typedef string obj_ref;
 
+    /*
+        input_tbls - FTICR AttributeMappings, one per sample
+        T, pH, eta, delGsyn - a single set of thermodynamic conditions
+    */
+    typedef structure {
+        list<obj_ref> input_tbls;
+        int n_lambda_bins;
+        float lambda_cutoff;
+        string bin_method;
+        string output_format;
+        int workers;
+        string T;
+        string pH;
+        string eta;
+        string delGsyn;
+        string workspace_name;
+        string output_surfix;
+    } BatchParams;
+
+    /* run_ThermoStoichWizard_batch: run_ThermoStoichWizard for many samples in one job */
+    funcdef run_ThermoStoichWizard_batch(BatchParams params) returns (ReportResults output) authentication required;
+
+    /*
+        correlation_plots - "all" (default), "none" or comma separated "vh_cs:vh_o2" grid cells
+        max_plot_points - largest number of compounds drawn in each correlation plot
+        plot_workers - number of processes drawing the correlation plots
+    */
     typedef structure {
         obj_ref lambda_tbl;
         obj_ref stoich_tbl;
         string vh_cs;
         string vh_o2;
         string workspace_name;
+        string correlation_plots;
+        int max_plot_points;
+        int plot_workers;
       } LambdaParams;
 
     /* run_lambda_analysis: perform lambda analysis*/
@@ -0,0 +1,266 @@
+import logging
+import os
+import re
+import pandas as pd
+import numpy as np
+
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+from installed_clients.DataFileUtilClient import DataFileUtil
+from installed_clients.KBaseReportClient import KBaseReport
+
+from ThermoStoichWizard.ThermoStoichiometry import FTICRResult, lambda_bin_edges, write_table
+from ThermoStoichWizard.ThermoStoichCache import open_cache
+from ThermoStoichWizard.StageTimer import StageTimer
+from ThermoStoichWizard.DistributionSketch import compare_samples, save_sketches, SKETCH_METRICS
+
+
+class BatchAnalysis(object):
+    """run_ThermoStoichWizard for many FTICR AttributeMappings in one job
+
+    The objects are fetched together, the thermodynamics are computed once
+    over the union of their compositions and every sample is binned with the
+    same lambda bin edges (from the union of the compounds), so Bin k is the
+    same lambda interval in every sample of the sample x bin matrix.
+    """
+    def __init__(self, config):
+        super(BatchAnalysis, self).__init__()
+        self.config = config
+        self.callback_url = os.environ['SDK_CALLBACK_URL']
+        self.shared_folder = os.path.abspath(config['scratch'])
+        logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+    def run(self, params, ctx=None, model_params=None):
+        print("run batch thermo stoichiometry")
+        timer = StageTimer(ctx)
+        input_tbls = params['input_tbls']
+        if isinstance(input_tbls, str):
+            input_tbls = [ref.strip() for ref in input_tbls.split(',') if ref.strip()]
+        n_lambda_bins = int(params['n_lambda_bins'])
+        lambda_cutoff = float(params['lambda_cutoff'])
+        bin_method = params['bin_method']
+        workers = int(params.get('workers', 1))
+        output_format = params.get('output_format', 'csv')
+
+        with timer.stage('fetch input objects'):
+            dfu = DataFileUtil(self.callback_url)
+            objects = dfu.get_objects({'object_refs': input_tbls})['data']
+        samples = self._sample_names([obj['info'][1] for obj in objects])
+
+        with timer.stage('formula assignment'):
+            fticrs = []
+            # drop each object once its table is extracted
+            while objects:
+                fticrs.append(FTICRResult.from_attribute_mapping(objects.pop(0)['data']))
+
+        # off unless "thermo-cache-path" is configured
+        with timer.stage('thermo computation'), open_cache(self.config) as cache:
+            num_cpds, cache_hits, cache_misses = FTICRResult.run_samples(
+                fticrs, cache=cache, workers=workers, model_params=model_params)
+            cache_stats = 'off' if cache is None else '{}/{}'.format(cache_hits, cache_misses)
+        num_peaks = sum(fticr.num_peaks for fticr in fticrs)
+        print('num_samples:{}, num_peaks:{}, num_cpds:{}'.format(len(fticrs), num_peaks, num_cpds))
+        print('cache hits:{}, cache misses:{}'.format(cache_hits, cache_misses))
+
+        with timer.stage('lambda binning'):
+            if bin_method == 'cumulative' and not n_lambda_bins < num_cpds:
+                raise ValueError('n_lambda_bins must be smaller than the number of compounds: {}'
+                                 .format(num_cpds))
+            bins = self._pooled_lambda_bins(fticrs, n_lambda_bins, lambda_cutoff, bin_method)
+            print("bins:", bins)
+            new_comps = [fticr._average_by_bins(bins) for fticr in fticrs]
+            bin_matrix = self._bin_matrix(fticrs, samples, bins)
+            summary = self._sample_summary(fticrs, samples, input_tbls)
+
+        with timer.stage('distribution comparison'):
+            # the distances only need the sketches, not the compound tables
+            sketches = {sample: fticr.distribution_sketches()
+                        for sample, fticr in zip(samples, fticrs)}
+            distances = {metric: compare_samples(sketches, metric=metric)
+                         for metric in SKETCH_METRICS}
+
+        output_folder = os.path.join(self.shared_folder, 'csv')
+        os.mkdir(output_folder)
+        with timer.stage('result tables'):
+            output_files = self._save_tables(fticrs, samples, new_comps, bin_matrix, summary,
+                                             output_folder, output_format)
+            output_files += self._save_distances(sketches, distances, output_folder, output_format)
+
+        html_folder = os.path.join(self.shared_folder, 'html')
+        os.mkdir(html_folder)
+        with timer.stage('figures'):
+            heatmap_path = os.path.join(html_folder, 'lambda_bins_by_sample.png')
+            self._plot_bin_matrix(bin_matrix, heatmap_path)
+        output_files.append({'path': heatmap_path, 'name': 'lambda_bins_by_sample.png',
+                             'label': 'share of peaks in each lambda bin by sample',
+                             'description': 'share of peaks in each lambda bin by sample'})
+
+        html_str = '<div class="col-md-12">'
+        html_str += '<div class="card mb-12 box-shadow">'
+        html_str += '<img class="card-img-top" alt="lambda_bins_by_sample" ' \
+            'src="lambda_bins_by_sample.png" style="width: 100%; display: block;">'
+        html_str += '<div class="card-body">'
+        html_str += '<p class="card-text">Share of the peaks of each sample in each lambda bin</p>'
+        html_str += '</div>'
+        html_str += '</div>'
+        html_str += '</div>'
+        html_str += '<div class="col-md-12">'
+        html_str += '<h4>Samples</h4>'
+        html_str += summary.to_html(classes='table table-sm', float_format='{:.4f}'.format,
+                                    border=0)
+        html_str += '</div>'
+
+        with open(os.path.join(os.path.dirname(__file__), 'templates', 'template.html'),
+                  'r') as template_file:
+            report_html = template_file.read()
+            report_html = report_html.replace(
+                'Number of peaks:',
+                'Number of samples: {}</h4><h4>Number of peaks: {}'.format(len(fticrs), num_peaks))
+            report_html = report_html.replace('Number of compounds:',
+                                              'Number of compounds: {}'.format(num_cpds))
+            conditions_str = 'T={T:g} K, pH={pH:g}, eta={eta:g}, delGsyn={delGsyn:g} kJ/mol X' \
+                .format(**fticrs[0].model_params) if fticrs else ''
+            report_html = report_html.replace('Thermodynamic conditions:',
+                                              'Thermodynamic conditions: ' + conditions_str)
+            report_html = report_html.replace('Thermodynamic cache (hits/misses):',
+                                              'Thermodynamic cache (hits/misses): ' + cache_stats)
+            report_html = report_html.replace('<!--[Results]-->', html_str)
+            report_html = report_html.replace('<!--[Performance]-->', timer.to_html())
+
+        with open(os.path.join(html_folder, "index.html"), 'w') as index_file:
+            index_file.write(report_html)
+
+        with timer.stage('report'):
+            report = KBaseReport(self.callback_url)
+            html_dir = {
+                'path': html_folder,
+                'name': 'index.html',
+                'description': 'Thermo Stoich Wizard Batch Report'
+            }
+            report_info = report.create_extended_report({
+                'objects_created': [],
+                'file_links': output_files,
+                'html_links': [html_dir],
+                'direct_html_link_index': 0,
+                'report_object_name':
+                    'thermo_stoich_wizard_batch_report_' + params['output_surfix'],
+                'workspace_name': params['workspace_name']
+            })
+
+        return {
+            'report_name': report_info['name'],
+            'report_ref': report_info['ref'],
+            'performance': timer.to_list(),
+        }
+
+    @staticmethod
+    def _sample_names(names):
+        '''object names made unique (and safe as folder names)'''
+        safe = [re.sub(r'[^\w.-]', '_', name) for name in names]
+        counts = pd.Series(safe).groupby(safe).cumcount()
+        return [name if n == 0 else '{}_{}'.format(name, n) for name, n in zip(safe, counts)]
+
+    @staticmethod
+    def _pooled_lambda_bins(fticrs, n_bins, cutoff, bin_method):
+        '''lambda bin edges (see LambdaBinIndex) over the unique compounds of
+            the union of the samples
+        '''
+        cpd_mf = np.concatenate([fticr.thermo.index.values for fticr in fticrs])
+        cpd_lambda = np.concatenate([fticr.thermo.lambda_O2.values for fticr in fticrs])
+        # a composition has the same formula (and lambda) in every sample
+        _, first = np.unique(cpd_mf, return_index=True)
+        return lambda_bin_edges(np.sort(cpd_lambda[first]), n_bins, cutoff, bin_method)
+
+    @staticmethod
+    def _bin_matrix(fticrs, samples, bins):
+        '''sample x bin matrix of the share of the assigned peaks in each bin'''
+        counts = np.array([fticr.lambda_bin_index.counts(bins) for fticr in fticrs],
+                          dtype=np.float64)
+        num_assigned = np.array([fticr._cpd_index.size for fticr in fticrs], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = counts/num_assigned[:, None]
+        labels = ['Bin{}'.format(i+1) for i in range(len(bins)-1)]
+        return pd.DataFrame(shares, index=pd.Index(samples, name='sample'), columns=labels)
+
+    @staticmethod
+    def _sample_summary(fticrs, samples, refs):
+        '''peaks, compounds and lambda statistics of each sample'''
+        stats = np.array([fticr.get_summary('lambda_O2') for fticr in fticrs]).reshape(-1, 3)
+        return pd.DataFrame({
+            'ref': refs,
+            'num_peaks': [fticr.num_peaks for fticr in fticrs],
+            'num_cpds': [fticr.num_cpds for fticr in fticrs],
+            'lambda_mean': stats[:, 0],
+            'lambda_std': stats[:, 1],
+            'lambda_median': stats[:, 2],
+        }, index=pd.Index(samples, name='sample'))
+
+    @staticmethod
+    def _save_tables(fticrs, samples, new_comps, bin_matrix, summary, output_folder, output_format):
+        '''per-sample tables in one folder per sample, plus the combined
+            tables. Returns the file links for the report.
+        '''
+        samples_folder = os.path.join(output_folder, 'samples')
+        os.mkdir(samples_folder)
+        for fticr, sample, new_comp in zip(fticrs, samples, new_comps):
+            folder = os.path.join(samples_folder, sample)
+            os.mkdir(folder)
+            fticr.save_result_files(folder, fmt=output_format,
+                                    tables=["stoichMet_O2", "thermodynamic_props"])
+            write_table(new_comp, os.path.join(folder, "avg_comp_from_lambda_bins"),
+                        fmt=output_format)
+        # KBaseReport zips a linked folder
+        output_files = [{'path': samples_folder, 'name': 'samples.zip',
+                         'label': 'per-sample result tables',
+                         'description': 'stoichMet_O2, thermodynamic properties and '
+                                        'lambda bin averages of each sample'}]
+
+        combined = pd.concat(new_comps, keys=samples,
+                             names=['sample', None]).reset_index(level=0)
+        tables = [
+            (bin_matrix, 'lambda_bins_by_sample', True,
+             'share of peaks in each lambda bin by sample'),
+            (combined, 'avg_comp_from_lambda_bins', False,
+             'average compositions for each lambda bin and sample'),
+            (summary, 'sample_summary', True,
+             'peaks, compounds and lambda statistics of each sample'),
+        ]
+        for df, name, index, description in tables:
+            path = write_table(df, os.path.join(output_folder, name), fmt=output_format,
+                               index=index)
+            output_files.append({'path': path, 'name': os.path.basename(path),
+                                 'label': name, 'description': description})
+        return output_files
+
+    @staticmethod
+    def _save_distances(sketches, distances, output_folder, output_format):
+        '''the sketches of all samples and a sample x sample distance matrix
+            per metric and property. Returns the file links for the report.
+        '''
+        sketches_path = os.path.join(output_folder, 'distribution_sketches.json')
+        save_sketches(sketches_path, sketches)
+        output_files = [{'path': sketches_path, 'name': os.path.basename(sketches_path),
+                         'label': 'distribution sketches',
+                         'description': 'histograms of lambda_O2, lambda_HCO3 and delGcox0PerC '
+                                        'of each sample'}]
+        for metric, matrices in distances.items():
+            for column, matrix in matrices.items():
+                name = '{}_distance_{}'.format(metric, column)
+                path = write_table(matrix, os.path.join(output_folder, name), fmt=output_format)
+                output_files.append({'path': path, 'name': os.path.basename(path), 'label': name,
+                                     'description': '{} distance of {} between samples'
+                                                    .format(metric, column)})
+        return output_files
+
+    @staticmethod
+    def _plot_bin_matrix(bin_matrix, fout):
+        plt.figure(figsize=(8, max(4, 0.25*bin_matrix.shape[0])))
+        g = sns.heatmap(bin_matrix, cmap='viridis', cbar_kws={'label': 'share of peaks'},
+                        yticklabels=bin_matrix.shape[0] <= 100)
+        g.set_xlabel('lambda bin', fontsize=15)
+        g.set_ylabel('sample', fontsize=15)
+        plt.tight_layout()
+        plt.savefig(fout)
+        plt.close('all')
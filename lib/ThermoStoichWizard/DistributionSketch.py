@@ -0,0 +1,210 @@
+'''
+Mergeable fixed-edge histograms of the thermodynamic properties and the
+distances between samples computed from them
+'''
+
+import json
+
+import numpy as np
+import pandas as pd
+
+# fixed edges shared by every sample, so sketches can be merged and compared
+SKETCH_EDGES = {
+    'lambda_O2': np.linspace(0, 0.5, 501),
+    'lambda_HCO3': np.linspace(0, 0.5, 501),
+    'delGcox0PerC': np.linspace(-100, 200, 301),
+}
+SKETCH_COLUMNS = list(SKETCH_EDGES)
+SKETCH_METRICS = ['wasserstein', 'ks']
+# largest number of sample pairs x edges compared at once
+DISTANCE_CHUNK_ELEMENTS = 2**24
+
+
+class DistributionSketch(object):
+    """histogram of one variable over fixed edges
+
+    Besides the counts of the right-open bins [edges[i], edges[i+1]) (the
+    last bin is closed), the values below and above the edges are counted
+    with their sums, and the count, sum, minimum and maximum of all finite
+    values are kept; NaN and infinite values are only counted. Everything
+    is a sum or an extreme, so sketches with the same edges merge exactly.
+    The CDF is taken as linear within each bin and within the tails
+    (between the minimum and the first edge, the last edge and the maximum).
+    """
+    def __init__(self, edges, counts=None, underflow=0, overflow=0, under_sum=0.0, over_sum=0.0,
+                 count=0, total=0.0, minimum=np.inf, maximum=-np.inf, nonfinite=0):
+        super(DistributionSketch, self).__init__()
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(self.edges.size-1, dtype=np.int64) if counts is None \
+            else np.asarray(counts, dtype=np.int64)
+        self.underflow = int(underflow)
+        self.overflow = int(overflow)
+        self.under_sum = float(under_sum)
+        self.over_sum = float(over_sum)
+        self.count = int(count)
+        self.total = float(total)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.nonfinite = int(nonfinite)
+
+    @classmethod
+    def from_values(cls, values, edges):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        values = values[finite]
+        edges = np.asarray(edges, dtype=np.float64)
+        below = values < edges[0]
+        above = values > edges[-1]
+        inside = values[~(below | above)]
+        # the last edge belongs to the last bin, like np.histogram
+        bins = np.minimum(np.searchsorted(edges, inside, side='right')-1, edges.size-2)
+        return cls(edges,
+                   counts=np.bincount(bins, minlength=edges.size-1),
+                   underflow=below.sum(), overflow=above.sum(),
+                   under_sum=values[below].sum(), over_sum=values[above].sum(),
+                   count=values.size, total=values.sum(),
+                   minimum=values.min() if values.size else np.inf,
+                   maximum=values.max() if values.size else -np.inf,
+                   nonfinite=finite.size-values.size)
+
+    def merge(self, other):
+        '''the sketch of the values of both sketches'''
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Only sketches with the same edges can be merged')
+        return DistributionSketch(self.edges, counts=self.counts+other.counts,
+                                  underflow=self.underflow+other.underflow,
+                                  overflow=self.overflow+other.overflow,
+                                  under_sum=self.under_sum+other.under_sum,
+                                  over_sum=self.over_sum+other.over_sum,
+                                  count=self.count+other.count, total=self.total+other.total,
+                                  minimum=min(self.minimum, other.minimum),
+                                  maximum=max(self.maximum, other.maximum),
+                                  nonfinite=self.nonfinite+other.nonfinite)
+
+    def mean(self):
+        return self.total/self.count if self.count else np.nan
+
+    def cdf(self):
+        '''fraction of the finite values below each edge (the first edge
+            counts the underflow, the last one everything but the overflow)
+        '''
+        cum = self.underflow+np.concatenate([[0], np.cumsum(self.counts)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cum/self.count
+
+    def quantile(self, q):
+        '''quantiles interpolated on the piecewise linear CDF, within the
+            minimum and maximum
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        # the tails stretch from the minimum and to the maximum
+        x = np.concatenate([[min(self.minimum, self.edges[0])], self.edges,
+                            [max(self.maximum, self.edges[-1])]])
+        f = np.concatenate([[0], self.cdf(), [1]])
+        # np.interp needs increasing f: take the left end of flat stretches
+        keep = np.concatenate([[True], np.diff(f) > 0])
+        return np.clip(np.interp(q, f[keep], x[keep]), self.minimum, self.maximum)
+
+    def to_dict(self):
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts.tolist(),
+            'underflow': self.underflow, 'overflow': self.overflow,
+            'under_sum': self.under_sum, 'over_sum': self.over_sum,
+            'count': self.count, 'total': self.total,
+            # json has no infinity, an empty sketch has no extremes
+            'minimum': self.minimum if self.count else None,
+            'maximum': self.maximum if self.count else None,
+            'nonfinite': self.nonfinite,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        if d.get('minimum') is None:
+            d['minimum'] = np.inf
+        if d.get('maximum') is None:
+            d['maximum'] = -np.inf
+        return cls(**d)
+
+
+def merge_sketches(sketches):
+    '''the merged sketch of a non-empty list of sketches'''
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged = merged.merge(sketch)
+    return merged
+
+
+def sketch_distances(sketches, metric='wasserstein', max_elements=DISTANCE_CHUNK_ELEMENTS):
+    '''(S, S) distances between S sketches with the same edges.
+
+        "ks": largest difference of the CDFs at the edges.
+        "wasserstein": area between the piecewise linear CDFs over the edges,
+        plus the differences of the mean distances of the tails to the first
+        and last edges (exact when at most one of the two has a tail).
+    '''
+    if metric not in SKETCH_METRICS:
+        raise ValueError('metric must be one of {}: {}'.format(SKETCH_METRICS, metric))
+    edges = sketches[0].edges
+    if any(not np.array_equal(edges, sketch.edges) for sketch in sketches):
+        raise ValueError('Only sketches with the same edges can be compared')
+    num_sketches = len(sketches)
+    cdfs = np.array([sketch.cdf() for sketch in sketches])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # E[(edges[0]-X)+] and E[(X-edges[-1])+] of each sketch
+        counts = np.array([sketch.count for sketch in sketches], dtype=np.float64)
+        lower = np.array([s.underflow*edges[0]-s.under_sum for s in sketches])/counts
+        upper = np.array([s.over_sum-s.overflow*edges[-1] for s in sketches])/counts
+    widths = np.diff(edges)
+
+    distances = np.empty((num_sketches, num_sketches))
+    rows_per_chunk = max(1, max_elements // max(1, num_sketches*edges.size))
+    for start in range(0, num_sketches, rows_per_chunk):
+        stop = min(start+rows_per_chunk, num_sketches)
+        # (rows, S, edges) differences of the CDFs
+        diff = cdfs[start:stop, None, :]-cdfs[None, :, :]
+        if metric == 'ks':
+            distances[start:stop] = np.abs(diff).max(axis=-1)
+            continue
+        d0 = diff[..., :-1]
+        d1 = diff[..., 1:]
+        a0 = np.abs(d0)
+        a1 = np.abs(d1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # the area of |d| over a bin where d goes linearly from d0 to d1
+            crossing = (a0**2+a1**2)/(2*(a0+a1))
+        area = np.where(d0*d1 >= 0, (a0+a1)/2, crossing)
+        distances[start:stop] = (area*widths).sum(axis=-1) + \
+            np.abs(lower[start:stop, None]-lower[None, :]) + \
+            np.abs(upper[start:stop, None]-upper[None, :])
+    return distances
+
+
+def compare_samples(sample_sketches, metric='wasserstein'):
+    '''sample x sample distance matrices, one per column, from the sketches
+        of each sample ({sample: {column: DistributionSketch}})
+    '''
+    samples = list(sample_sketches)
+    columns = [c for c in SKETCH_COLUMNS if all(c in sample_sketches[s] for s in samples)]
+    index = pd.Index(samples, name='sample')
+    return {column: pd.DataFrame(sketch_distances([sample_sketches[s][column] for s in samples],
+                                                  metric=metric),
+                                 index=index, columns=samples)
+            for column in columns}
+
+
+def save_sketches(fout, sample_sketches):
+    '''write {sample: {column: DistributionSketch}} as json'''
+    with open(fout, 'w') as f:
+        json.dump({sample: {column: sketch.to_dict() for column, sketch in sketches.items()}
+                   for sample, sketches in sample_sketches.items()}, f)
+
+
+def load_sketches(fin):
+    '''inverse of save_sketches'''
+    with open(fin) as f:
+        return {sample: {column: DistributionSketch.from_dict(d) for column, d in sketches.items()}
+                for sample, sketches in json.load(f).items()}
@@ -4,7 +4,7 @@ import uuid
 import pandas as pd
 import numpy as np
 import itertools
-from scipy.stats import pearsonr
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -13,6 +13,21 @@ from matplotlib import cm
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBaseReportClient import KBaseReport
 
+from ThermoStoichWizard.StageTimer import StageTimer
+
+# largest number of values held at once by the correlation grid
+GRID_CHUNK_ELEMENTS = 2**24
+# full size arrays alive at once per grid block: the rates, their product
+# with |acceptor| or |hco3| and its centered copy in _batch_pearsonr
+GRID_TEMPORARIES = 3
+# default cap on the compounds drawn in each correlation plot
+MAX_PLOT_POINTS = 5000
+
+
+def _use_agg_backend():
+    '''initializer of the plotting processes'''
+    plt.switch_backend('Agg')
+
 class LambdaAnalysis(object):
     """docstring for LambdaAnalysis"""
     def __init__(self, config):
@@ -22,81 +37,86 @@ class LambdaAnalysis(object):
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
 
-    def run(self, params):
+    def run(self, params, ctx=None):
         print("run lambda analysis")
+        timer = StageTimer(ctx)
         vh_cs = [float(i) for i in params["vh_cs"].split(",")]
         vh_o2 = [float(i) for i in params["vh_o2"].split(",")]
         
-        df = self._fetch_df_from_refs([params["lambda_tbl"], params["stoich_tbl"]])
+        with timer.stage('fetch tables'):
+            df = self._fetch_df_from_refs([params["lambda_tbl"], params["stoich_tbl"]])
 
         mu_max = 1
 
         html_folder = os.path.join(self.shared_folder, 'html')
         os.mkdir(html_folder)
 
-        vis_content = ''
-        X, Y = np.meshgrid(vh_cs, vh_o2)
-        # corr_mats = {i:np.zeros(X.shape) for i in ['r_lambda_rbiom','r_lambda_ro2','r_lambda_rhco3']}
-        corr_mats = {i:np.zeros(X.shape) for i in ['r_lambda_rbiom','r_lambda_ro2']}
-        print(corr_mats)
-        for i in range(len(vh_cs)):
-            for j in range(len(vh_o2)):
-                vhcs = X[i,j]
-                vho2 = Y[i,j]
+        # "all" (default), "none" or a comma separated list of "vh_cs:vh_o2" cells
+        correlation_plots = params.get("correlation_plots", "all")
+        max_plot_points = int(params.get("max_plot_points", MAX_PLOT_POINTS))
+        plot_workers = int(params.get("plot_workers", 1))
 
-                df['r_biom'] = mu_max * np.exp(-np.abs(df['donor'])/vhcs)* np.exp(-np.abs(df['acceptor'])/vho2)
-                df['r_o2'] = np.abs(df['acceptor']) * df['r_biom']
-                df['r_hco3'] = np.abs(df['hco3']) * df['r_biom']
+        vis_content = ''
+        # correlation matrices: rows are vh_o2, columns are vh_cs
+        with timer.stage('correlation grid'):
+            corr_mats = self._correlation_grid(df, vh_cs, vh_o2, mu_max=mu_max)
 
-                print(vhcs, vho2)
+        with timer.stage('correlation plots'):
+            plot_jobs = []
+            for i, j in self._select_plot_cells(correlation_plots, vh_cs, vh_o2):
+                vhcs = vh_cs[j]
+                vho2 = vh_o2[i]
 
+                rates = self._rates(self._sample_rows(df, max_plot_points), vhcs, vho2,
+                                    mu_max=mu_max)
                 fout = 'correlation_plot_vhcs={:.2f}_vho2={:.2f}.png'.format(vhcs, vho2)
                 fpath = os.path.join(html_folder, fout)
-                r_lambda_rbiom, r_lambda_ro2, r_lambda_rhco3 = self._plot_correlation(df, fout=fpath)
-
-                corr_mats['r_lambda_rbiom'][i,j] = r_lambda_rbiom[0]
-                corr_mats['r_lambda_ro2'][i,j] = r_lambda_ro2[0]
-                # corr_mats['r_lambda_rhco3'][i,j] = r_lambda_rhco3[0]
+                plot_jobs.append((rates, corr_mats['r_lambda_rbiom'][i, j],
+                                  corr_mats['r_lambda_ro2'][i, j], fpath))
 
                 vis_content += '<div>'
-                vis_content += '<h3>V<sub>h</sub>[OC]={:.2f}, V<sub>h</sub>[O<sub>2</sub>]={:.2f}<h4>'.format(vhcs, vho2)
-                vis_content += '<img alt="{0}" src="{0}" style="width: 100%; display: block;">'.format(fout)
+                vis_content += '<h3>V<sub>h</sub>[OC]={:.2f}, '.format(vhcs)
+                vis_content += 'V<sub>h</sub>[O<sub>2</sub>]={:.2f}<h4>'.format(vho2)
+                vis_content += '<img alt="{0}" src="{0}" style="width: 100%; display: block;">'\
+                    .format(fout)
                 vis_content += '</div>'
+            self._render_correlation_plots(plot_jobs, workers=plot_workers)
 
-        plt.close('all')
-        fig = plt.figure(figsize=(9,3))
-        for i, (corr, label) in enumerate(zip(['r_lambda_rbiom','r_lambda_ro2'],
-                                              ["$r_{Biom}$","|$r_{O_2}$|"])):
+        with timer.stage('correlation heatmaps'):
+            plt.close('all')
+            fig = plt.figure(figsize=(9, 3))
+            for i, (corr, label) in enumerate(zip(['r_lambda_rbiom', 'r_lambda_ro2'],
+                                                  ["$r_{Biom}$", "|$r_{O_2}$|"])):
             
-            ax = fig.add_subplot(1, 3, i+1)
-            tdf = pd.DataFrame(corr_mats[corr], columns=vh_cs)
-            tdf.index = vh_o2
-            sns.heatmap(tdf, center=0, cmap="RdBu_r", annot=True, fmt=".2f", ax=ax)
-            ax.set_xlabel(r"$V_h[OC]$")
-            ax.set_ylabel(r"$V_h[O_2]$")
-
-            # print(i)
-            # Z = corr_mats[corr]
-            # # set up the axes for the first plot
-            # ax = fig.add_subplot(1, 3, i+1, projection='3d')
-
-            # # plot a 3D surface like in the example mplot3d/surface3d_demo
-            # surf = ax.plot_surface(X, Y, Z, rstride=1, cstride=1, cmap=cm.coolwarm,
-            #                        linewidth=0, antialiased=False)
+                ax = fig.add_subplot(1, 3, i+1)
+                tdf = pd.DataFrame(corr_mats[corr], columns=vh_cs)
+                tdf.index = vh_o2
+                sns.heatmap(tdf, center=0, cmap="RdBu_r", annot=True, fmt=".2f", ax=ax)
+                ax.set_xlabel(r"$V_h[OC]$")
+                ax.set_ylabel(r"$V_h[O_2]$")
+
+                # print(i)
+                # Z = corr_mats[corr]
+                # # set up the axes for the first plot
+                # ax = fig.add_subplot(1, 3, i+1, projection='3d')
+
+                # # plot a 3D surface like in the example mplot3d/surface3d_demo
+                # surf = ax.plot_surface(X, Y, Z, rstride=1, cstride=1, cmap=cm.coolwarm,
+                #                        linewidth=0, antialiased=False)
             
-            # ax.dist = 10
-            # ax.azim = -115
-            # ax.set_zlim(-1.01, 1.01)
-            # ax.set_xlabel(r"$V_h[C_s]$")
-            # ax.set_ylabel(r"$V_h[O_2]$")
-            # ax.set_zlabel(r"$\rho$", rotation=180)
-            ax.set_title(r"$\rho$($\lambda$," + label + ")")
-
-            # fig.colorbar(surf, shrink=0.5, aspect=10)
-
-        plt.tight_layout()
-        plt.savefig(os.path.join(html_folder, "correlation_3d.png"))
-        
+                # ax.dist = 10
+                # ax.azim = -115
+                # ax.set_zlim(-1.01, 1.01)
+                # ax.set_xlabel(r"$V_h[C_s]$")
+                # ax.set_ylabel(r"$V_h[O_2]$")
+                # ax.set_zlabel(r"$\rho$", rotation=180)
+                ax.set_title(r"$\rho$($\lambda$," + label + ")")
+
+                # fig.colorbar(surf, shrink=0.5, aspect=10)
+
+            plt.tight_layout()
+            plt.savefig(os.path.join(html_folder, "correlation_3d.png"))
+
         corr_content = '<img alt="{0}" src="{0}" style="width: 100%; display: block;">'.format("correlation_3d.png")
 
         with open(os.path.join(os.path.dirname(__file__), 'templates', 'lambda_template.html'),
@@ -104,30 +124,33 @@ class LambdaAnalysis(object):
             report_html = template_file.read()
             report_html = report_html.replace('<p>Visualization_Content</p>', vis_content)
             report_html = report_html.replace('<p>3D Correlation Plot</p>', corr_content)
+            report_html = report_html.replace('<p>Performance_Content</p>', timer.to_html())
             # report_html = report_html.replace('Number of compounds:', 'Number of compounds: {}'.format(num_cpds))
             # report_html = report_html.replace('<!--[Results]-->', html_str)
             
         with open(os.path.join(html_folder, "index.html"), 'w') as index_file:
             index_file.write(report_html)
 
-        report = KBaseReport(self.callback_url)
-        html_dir = {
-            'path': html_folder,
-            'name': 'index.html',
-            'description': 'Lambda Analysis Report'
-        }
-        report_info = report.create_extended_report({
-            # # 'objects_created': objects_created,
-            # 'file_links': output_files,
-            'html_links': [html_dir],
-            'direct_html_link_index': 0,
-            # 'report_object_name': 'miia_report_' + params['output_suffix'],
-            'workspace_name': params['workspace_name']
-        })
+        with timer.stage('report'):
+            report = KBaseReport(self.callback_url)
+            html_dir = {
+                'path': html_folder,
+                'name': 'index.html',
+                'description': 'Lambda Analysis Report'
+            }
+            report_info = report.create_extended_report({
+                # # 'objects_created': objects_created,
+                # 'file_links': output_files,
+                'html_links': [html_dir],
+                'direct_html_link_index': 0,
+                # 'report_object_name': 'miia_report_' + params['output_suffix'],
+                'workspace_name': params['workspace_name']
+            })
 
         output = {
             'report_name': report_info['name'],
             'report_ref': report_info['ref'],
+            'performance': timer.to_list(),
         }
 
         return output
@@ -145,13 +168,106 @@ class LambdaAnalysis(object):
         tbl_cols = [info['attribute'] for info in json_data['data']['attributes']]
         return pd.DataFrame.from_dict(json_data['data']['instances'], orient='index', columns=tbl_cols, dtype=np.float)
 
-    def _plot_correlation(self, df, fout):
-        r_lambda_rbiom = pearsonr(df['lambda_O2'], df['r_biom'])
-        r_lambda_ro2 = pearsonr(df['lambda_O2'], df['r_o2'])
-        r_lambda_rhco3 = pearsonr(df['lambda_O2'], df['r_hco3'])
+    @staticmethod
+    def _select_plot_cells(correlation_plots, vh_cs, vh_o2):
+        '''(vh_o2 index, vh_cs index) of the grid cells to plot
+        '''
+        correlation_plots = correlation_plots.strip().lower()
+        if correlation_plots == 'all':
+            return [(i, j) for i in range(len(vh_o2)) for j in range(len(vh_cs))]
+        if correlation_plots in ('none', ''):
+            return []
+
+        cells = []
+        for cell in correlation_plots.split(','):
+            vhcs, vho2 = [float(v) for v in cell.split(':')]
+            if vhcs not in vh_cs or vho2 not in vh_o2:
+                raise ValueError('Correlation plot cell {} is not in the grid'.format(cell))
+            cells.append((vh_o2.index(vho2), vh_cs.index(vhcs)))
+        return cells
+
+    @staticmethod
+    def _sample_rows(df, max_rows, seed=0):
+        '''at most max_rows rows of df, drawn without replacement
+        '''
+        if max_rows <= 0 or df.shape[0] <= max_rows:
+            return df
+        return df.sample(n=max_rows, random_state=seed)
+
+    def _render_correlation_plots(self, plot_jobs, workers=1):
+        '''draw the correlation plots, in a pool of processes on the Agg
+            backend when workers > 1
+        '''
+        if workers <= 1 or len(plot_jobs) <= 1:
+            for job in plot_jobs:
+                self._plot_correlation(*job)
+            return
 
-        # print(r_lambda_rbiom, r_lambda_ro2, r_lambda_rhco3)
+        with ProcessPoolExecutor(max_workers=min(workers, len(plot_jobs)),
+                                 initializer=_use_agg_backend) as executor:
+            futures = [executor.submit(LambdaAnalysis._plot_correlation, *job) for job in plot_jobs]
+            for future in futures:
+                future.result()
 
+    @staticmethod
+    def _rates(df, vhcs, vho2, mu_max=1):
+        '''rates of a single (vh_cs, vh_o2) grid point, leaving df untouched
+        '''
+        rates = pd.DataFrame({'lambda_O2': df['lambda_O2']})
+        rates['r_biom'] = mu_max * np.exp(-np.abs(df['donor'])/vhcs) * \
+            np.exp(-np.abs(df['acceptor'])/vho2)
+        rates['r_o2'] = np.abs(df['acceptor']) * rates['r_biom']
+        rates['r_hco3'] = np.abs(df['hco3']) * rates['r_biom']
+        return rates
+
+    @staticmethod
+    def _batch_pearsonr(x, Y):
+        '''Pearson correlation coefficients between x (N,) and each row of Y (..., N)
+        '''
+        xc = x - x.mean()
+        Yc = Y - Y.mean(axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = Yc.dot(xc) / (np.sqrt(np.einsum('...i,...i->...', Yc, Yc)) * np.sqrt(xc.dot(xc)))
+        return np.clip(r, -1, 1)
+
+    def _correlation_grid(self, df, vh_cs, vh_o2, mu_max=1, max_elements=GRID_CHUNK_ELEMENTS):
+        '''correlations of lambda with r_biom, |r_o2| and |r_hco3| over the
+            whole (vh_o2 x vh_cs) grid. The rate model is evaluated as a
+            broadcast (vh_o2 block x vh_cs block x N) array, with blocks
+            sized on both axes so that the GRID_TEMPORARIES arrays of a
+            block hold at most max_elements values (one cell at a time when
+            N alone is larger).
+        '''
+        vh_cs = np.asarray(vh_cs, dtype=np.float64)
+        vh_o2 = np.asarray(vh_o2, dtype=np.float64)
+        lambda_O2 = df['lambda_O2'].values.astype(np.float64)
+        abs_donor = np.abs(df['donor'].values.astype(np.float64))
+        abs_acceptor = np.abs(df['acceptor'].values.astype(np.float64))
+        abs_hco3 = np.abs(df['hco3'].values.astype(np.float64))
+
+        # exp(-|donor|/vhcs)*exp(-|acceptor|/vho2) separates into the two axes
+        exp_cs = np.exp(-abs_donor[None, :]/vh_cs[:, None])
+        exp_o2 = np.exp(-abs_acceptor[None, :]/vh_o2[:, None])
+
+        corr_mats = {i: np.zeros((vh_o2.size, vh_cs.size))
+                     for i in ['r_lambda_rbiom', 'r_lambda_ro2', 'r_lambda_rhco3']}
+        num_cells = max(1, max_elements // max(1, GRID_TEMPORARIES*lambda_O2.size))
+        cs_chunk = min(vh_cs.size, num_cells)
+        o2_chunk = max(1, num_cells // cs_chunk)
+        for o2_start in range(0, vh_o2.size, o2_chunk):
+            o2 = slice(o2_start, o2_start+o2_chunk)
+            for cs_start in range(0, vh_cs.size, cs_chunk):
+                cs = slice(cs_start, cs_start+cs_chunk)
+                r_biom = mu_max * exp_cs[None, cs, :] * exp_o2[o2, None, :]
+                corr_mats['r_lambda_rbiom'][o2, cs] = self._batch_pearsonr(lambda_O2, r_biom)
+                corr_mats['r_lambda_ro2'][o2, cs] = \
+                    self._batch_pearsonr(lambda_O2, abs_acceptor*r_biom)
+                corr_mats['r_lambda_rhco3'][o2, cs] = \
+                    self._batch_pearsonr(lambda_O2, abs_hco3*r_biom)
+        return corr_mats
+
+    @staticmethod
+    def _plot_correlation(df, r_lambda_rbiom, r_lambda_ro2, fout):
         fig, ax = plt.subplots(2,2, figsize=(8,5))
         sns.distplot(df['r_biom'], ax=ax[0,0])
         sns.distplot(df['r_o2'], ax=ax[0,1])
@@ -160,16 +276,16 @@ class LambdaAnalysis(object):
         ax[0,1].set_xlabel(r"|$r_{O_2}$|")
         # ax[0,2].set_xlabel(r"$r_{HCO_3^-}$")
 
-        sns.scatterplot(df['lambda_O2'], df['r_biom'], alpha=0.6, ax=ax[1,0])
-        sns.scatterplot(df['lambda_O2'], df['r_o2'], alpha=0.6, ax=ax[1,1])
+        sns.scatterplot(x='lambda_O2', y='r_biom', data=df, alpha=0.6, ax=ax[1, 0])
+        sns.scatterplot(x='lambda_O2', y='r_o2', data=df, alpha=0.6, ax=ax[1, 1])
         # sns.scatterplot(df['lambda_O2'], df['r_hco3'], alpha=0.6, ax=ax[1,2])
         ax[1,0].set_ylabel(r"$r_{Biom}$")
         ax[1,1].set_ylabel(r"|$r_{O_2}$|")
         # ax[1,2].set_ylabel(r"$r_{HCO_3^-}$")
 
-        ax[1,0].set_title(r"$\rho$={:.3f}".format(r_lambda_rbiom[0]))
-        ax[1,1].set_title(r"$\rho$={:.3f}".format(r_lambda_ro2[0]))
-        # ax[1,2].set_title(r"$\rho$={:.3f}".format(r_lambda_rhco3[0]))
+        ax[1, 0].set_title(r"$\rho$={:.3f}".format(r_lambda_rbiom))
+        ax[1, 1].set_title(r"$\rho$={:.3f}".format(r_lambda_ro2))
+        # ax[1,2].set_title(r"$\rho$={:.3f}".format(r_lambda_rhco3))
 
         for i in range(2):
             ax[1,i].set_xlabel(r"$\lambda$")
@@ -177,5 +293,4 @@ class LambdaAnalysis(object):
         if fout:
             plt.tight_layout()
             plt.savefig(fout)
-        
-        return r_lambda_rbiom, r_lambda_ro2, r_lambda_rhco3
\ No newline at end of file
+        plt.close(fig)
@@ -0,0 +1,211 @@
+'''
+Propagate the formula assignment ambiguity and the uncertainty of the TEEM
+parameters (eta, delGsyn) to lambda
+'''
+
+import numpy as np
+import pandas as pd
+
+from ThermoStoichWizard.ThermoStoichiometry import (BatchThermoStoichiometry, lambda_bin_edges,
+                                                    CHEMICAL_ELEMENTS, REQUIRED_COLUMNS)
+
+DEFAULT_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# largest number of lambda values (samples x candidates) summarized at once,
+# also the number of (samples x peaks x bin edges) compared at once
+SUMMARY_CHUNK_ELEMENTS = 2**24
+
+
+class LambdaUncertainty(object):
+    """lambda_O2 of every candidate formula of every peak under Monte-Carlo
+    samples of eta and delGsyn
+
+    candidates is a long table with one row per candidate formula: the peak
+    in the peak_col column (or the index when peak_col is None) and the CHNOPS
+    counts. The unique candidate compositions share one stoichiometry basis
+    and all samples are evaluated at once by the TEEM on top of it. The
+    summaries and bin averages take large chunks of peaks or samples at a
+    time, so there is no Python loop over single peaks or samples.
+    Candidates without any element are dropped.
+    """
+    def __init__(self, candidates, peak_col=None, model_params=None):
+        super(LambdaUncertainty, self).__init__()
+        peaks = candidates.index if peak_col is None else candidates[peak_col]
+        comp = candidates[CHEMICAL_ELEMENTS].values.astype(np.float64)
+        assigned = comp.sum(axis=1) > 0
+
+        # candidates grouped by peak, in the order the peaks first appear
+        peak_codes, self.peaks = pd.factorize(np.asarray(peaks)[assigned])
+        order = np.argsort(peak_codes, kind='stable')
+        self._cand_peak = peak_codes[order]
+        self._peak_start = np.searchsorted(self._cand_peak, np.arange(len(self.peaks)))
+        self._peak_count = np.bincount(self._cand_peak, minlength=len(self.peaks))
+
+        # candidate -> unique composition
+        self.cpd_comp, self._cand_cpd = np.unique(comp[assigned][order], axis=0,
+                                                  return_inverse=True)
+        self._cand_cpd = self._cand_cpd.reshape(-1)
+
+        thermo_stoich = BatchThermoStoichiometry(self.cpd_comp, **(model_params or {}))
+        self.model_params = thermo_stoich.model_params()
+        self.basis = thermo_stoich.get_stoich_basis()
+        # eta and delGsyn do not enter the reaction energies
+        _, self._delGcat, self._delGan_O2, _ = self.basis.reaction_energies(
+            self.model_params['T'], self.model_params['pH'])
+        self.samples = None
+        self.cpd_lambda = None
+
+    @property
+    def num_peaks(self):
+        return len(self.peaks)
+
+    @property
+    def num_candidates(self):
+        return self._cand_cpd.size
+
+    def cpd_lambdas(self, eta, delGsyn):
+        '''lambda_O2 of the unique compositions: (N,) for scalars, (K, N)
+            for arrays of K (eta, delGsyn) pairs
+        '''
+        eta = np.asarray(eta, dtype=np.float64)
+        delGsyn = np.asarray(delGsyn, dtype=np.float64)
+        if eta.ndim or delGsyn.ndim:
+            eta, delGsyn = [v.reshape(-1, 1) for v in np.broadcast_arrays(eta, delGsyn)]
+        return self.basis.teem_lambda(self._delGcat, self._delGan_O2, eta, delGsyn)
+
+    def run(self, n_samples=100, eta_sd=0.05, delGsyn_sd=20, seed=0):
+        '''draw n_samples (eta, delGsyn) pairs from normal distributions
+            around the model parameters (eta kept in (0, 1], delGsyn >= 0)
+            and compute lambda of every unique composition under each of them
+            (at least 2 samples, for the standard deviations)
+        '''
+        if n_samples < 2:
+            raise ValueError('n_samples must be at least 2: {}'.format(n_samples))
+        rng = np.random.default_rng(seed)
+        eta = np.clip(rng.normal(self.model_params['eta'], eta_sd, n_samples), 1e-6, 1)
+        delGsyn = np.maximum(rng.normal(self.model_params['delGsyn'], delGsyn_sd, n_samples), 0)
+        self.samples = pd.DataFrame({'eta': eta, 'delGsyn': delGsyn})
+        self.cpd_lambda = self.cpd_lambdas(eta, delGsyn)
+
+    def nominal_lambda(self):
+        '''lambda of the first candidate of each peak under the model parameters'''
+        cpd_lambda = self.cpd_lambdas(self.model_params['eta'], self.model_params['delGsyn'])
+        return cpd_lambda[self._cand_cpd[self._peak_start]]
+
+    def peak_summary(self, quantiles=DEFAULT_QUANTILES):
+        '''per peak mean, standard deviation and quantiles of lambda over all
+            its candidates and all samples (pooled with equal weights), next
+            to the nominal lambda of its first candidate
+        '''
+        n_samples = self.cpd_lambda.shape[0]
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        stats = np.empty((self.num_peaks, 2+quantiles.size))
+
+        # peaks are summarized in contiguous chunks of candidates
+        max_candidates = max(1, self._peak_count.max(initial=1))
+        peaks_per_chunk = max(1, SUMMARY_CHUNK_ELEMENTS // (n_samples*max_candidates))
+        for first in range(0, self.num_peaks, peaks_per_chunk):
+            last = min(first+peaks_per_chunk, self.num_peaks)
+            rows = slice(self._peak_start[first], self._peak_start[last-1]+self._peak_count[last-1])
+            # (num_candidates*n_samples,) values sorted by peak, then lambda
+            values = self.cpd_lambda[:, self._cand_cpd[rows]].T.ravel()
+            groups = np.repeat(self._cand_peak[rows]-first, n_samples)
+            order = np.lexsort((values, groups))
+            values = values[order]
+
+            counts = self._peak_count[first:last]*n_samples
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.add.reduceat(values, starts)
+            means = sums/counts
+            sq = np.add.reduceat((values-np.repeat(means, counts))**2, starts)
+            stats[first:last, 0] = means
+            stats[first:last, 1] = np.sqrt(sq/np.maximum(counts-1, 1))
+
+            # linear interpolation between the closest ranks, like np.quantile
+            pos = quantiles[None, :]*(counts[:, None]-1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo+1, counts[:, None]-1)
+            t = pos-lo
+            a = values[starts[:, None]+lo]
+            b = values[starts[:, None]+hi]
+            stats[first:last, 2:] = a+(b-a)*t
+
+        summary = pd.DataFrame(stats, index=pd.Index(self.peaks, name='peak'),
+                               columns=['lambda_mean', 'lambda_std'] +
+                                       ['lambda_q{:g}'.format(q*100) for q in quantiles])
+        summary.insert(0, 'lambda_nominal', self.nominal_lambda())
+        summary.insert(0, 'num_candidates', self._peak_count)
+        return summary
+
+    def _bin_averages(self, cpd_lambda, cand, n_bins, cutoff, bin_method):
+        '''(S, n_bins, 7) averages of S samples, where every peak takes the
+            candidate cand[s] under the lambda cpd_lambda[s] (S, N), binned
+            like FTICRResult: edges from the compounds (unique chosen
+            compositions), averages over the peaks in (bins[i], bins[i+1]]
+        '''
+        num_samples = cand.shape[0]
+        peak_cpd = self._cand_cpd[cand]
+        peak_lambda = np.take_along_axis(cpd_lambda, peak_cpd, axis=1)
+
+        # compound lambda of each sample sorted first, the others at the end
+        chosen = np.zeros(cpd_lambda.shape, dtype=bool)
+        np.put_along_axis(chosen, peak_cpd, True, axis=1)
+        sorted_lambda = np.sort(np.where(chosen, cpd_lambda, np.inf), axis=1)
+        bins = lambda_bin_edges(sorted_lambda, n_bins, cutoff, bin_method,
+                                counts=chosen.sum(axis=1))
+        # a NaN lambda sorts last in LambdaBinIndex and gives NaN edges
+        bins[(chosen & np.isnan(cpd_lambda)).any(axis=1)] = np.nan
+        if np.any(np.diff(bins, axis=1) < 0):
+            raise ValueError('bins must increase monotonically: {}'.format(bins))
+
+        # bins[k] < lambda <= bins[k+1]: k+1 edges are below lambda
+        peak_bin = (bins[:, None, :] < peak_lambda[:, :, None]).sum(axis=-1)-1
+        inside = (peak_bin >= 0) & (peak_bin < n_bins)
+        groups = (np.arange(num_samples)[:, None]*n_bins+peak_bin)[inside]
+        values = np.column_stack([self.cpd_comp[peak_cpd[inside]], peak_lambda[inside]])
+        sums = np.column_stack([np.bincount(groups, weights=values[:, i],
+                                            minlength=num_samples*n_bins)
+                                for i in range(values.shape[1])])
+        counts = np.bincount(groups, minlength=num_samples*n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (sums/counts[:, None]).reshape(num_samples, n_bins, -1)
+
+    def bin_shifts(self, n_bins=10, cutoff=5, bin_method='cumulative', seed=0):
+        '''how the lambda bin averages move under the uncertainty. The
+            nominal averages take the first candidate of each peak under the
+            model parameters; every Monte-Carlo sample takes its own eta and
+            delGsyn and a random candidate per peak. The samples are binned
+            together, in chunks of SUMMARY_CHUNK_ELEMENTS. Returns one row per
+            bin and variable (CHNOPS and lambda) with the nominal value and
+            the mean, standard deviation and shift (mean - nominal) over
+            samples.
+        '''
+        nominal = self._bin_averages(
+            self.cpd_lambdas(self.model_params['eta'], self.model_params['delGsyn'])[None],
+            self._peak_start[None], n_bins, cutoff, bin_method)[0]
+
+        rng = np.random.default_rng(seed)
+        n_samples = self.cpd_lambda.shape[0]
+        choices = self._peak_start + np.floor(
+            rng.random((n_samples, self.num_peaks))*self._peak_count).astype(np.int64)
+        averages = np.empty((n_samples, n_bins, nominal.shape[1]))
+        per_sample = self.num_peaks*(n_bins+1)+self.cpd_comp.shape[0]
+        samples_per_chunk = max(1, SUMMARY_CHUNK_ELEMENTS // per_sample)
+        for start in range(0, n_samples, samples_per_chunk):
+            stop = min(start+samples_per_chunk, n_samples)
+            averages[start:stop] = self._bin_averages(self.cpd_lambda[start:stop],
+                                                      choices[start:stop],
+                                                      n_bins, cutoff, bin_method)
+
+        with np.errstate(invalid='ignore'):
+            mean = np.nanmean(averages, axis=0)
+            std = np.nanstd(averages, axis=0, ddof=1)
+        variables = REQUIRED_COLUMNS+['lambda']
+        labels = ['Bin{}'.format(i+1) for i in range(n_bins)]
+        return pd.DataFrame({
+            'Class': np.repeat(labels, len(variables)),
+            'variable': np.tile(variables, n_bins),
+            'nominal': nominal.ravel(),
+            'mean': mean.ravel(),
+            'std': std.ravel(),
+            'shift': (mean-nominal).ravel(),
+        })
@@ -0,0 +1,91 @@
+'''
+Wall time, CPU time and peak memory of the stages of a method
+'''
+
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """records how long each stage of a method takes
+
+    For every stage the wall time, the CPU time and the increase of the peak
+    resident memory (ru_maxrss, so only stages that raise the high-water mark
+    show up) are kept. Stages run on the main thread count the CPU time of the
+    whole process and of its finished child processes (e.g. the workers of
+    FTICRResult.run); stages run on other threads (the concurrent branches of
+    run_ThermoStoichWizard) count the CPU time of their own thread. Memory is
+    per process, so concurrent stages see each other's allocations.
+    """
+    def __init__(self, ctx=None):
+        super(StageTimer, self).__init__()
+        self.ctx = ctx
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cpu_time():
+        if threading.current_thread() is not threading.main_thread():
+            return time.thread_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def _peak_rss_mb():
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    @contextmanager
+    def stage(self, name):
+        '''time the body of a with statement as the stage name'''
+        wall = time.perf_counter()
+        cpu = self._cpu_time()
+        peak_rss = self._peak_rss_mb()
+        try:
+            yield
+        finally:
+            timing = {
+                'stage': name,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': self._cpu_time() - cpu,
+                'peak_rss_delta': self._peak_rss_mb() - peak_rss,
+            }
+            with self._lock:
+                self.stages.append(timing)
+            self.log('{stage}: wall {wall_time:.3f}s, cpu {cpu_time:.3f}s, '
+                     'peak rss +{peak_rss_delta:.1f}MB'.format(**timing))
+
+    def wrap(self, name, func):
+        '''func timed as the stage name, e.g. to submit it to an executor'''
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def log(self, message):
+        print(message)
+        if self.ctx is not None:
+            try:
+                self.ctx.log_info(message)
+            except AttributeError:
+                # a MethodContext made without a logger (as in the tests)
+                pass
+
+    def to_list(self):
+        '''the timings in the order the stages finished'''
+        with self._lock:
+            return [dict(timing) for timing in self.stages]
+
+    def to_html(self):
+        '''the "Performance" table of the report'''
+        html_str = '<h4>Performance</h4>'
+        html_str += '<table class="table table-sm">'
+        html_str += '<thead><tr><th>Stage</th><th>Wall time (s)</th><th>CPU time (s)</th>'
+        html_str += '<th>Peak RSS increase (MB)</th></tr></thead><tbody>'
+        for timing in self.to_list():
+            html_str += ('<tr><td>{stage}</td><td>{wall_time:.3f}</td><td>{cpu_time:.3f}</td>'
+                         '<td>{peak_rss_delta:.1f}</td></tr>').format(**timing)
+        html_str += '</tbody></table>'
+        return html_str
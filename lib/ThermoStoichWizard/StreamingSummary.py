@@ -0,0 +1,130 @@
+'''
+Mergeable streaming mean, variance and quantiles of a variable
+'''
+
+import numpy as np
+
+# t-digest compression: about compression/2 centroids are kept
+DEFAULT_COMPRESSION = 1000
+# values summarized at a time by summarize_columns
+SUMMARY_CHUNK_SIZE = 2**16
+
+
+class StreamingSummary(object):
+    """count, mean and variance (Welford, merged with Chan's formula) and a
+    t-digest of the finite values seen so far
+
+    update() takes chunks of values and merge() combines summaries of other
+    chunks, shards or samples; both keep the memory bounded by the
+    compression. The t-digest uses the arcsine scale function, so the
+    centroids are small in the tails and the quantiles there are accurate.
+    NaN and infinite values are only counted.
+    """
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        super(StreamingSummary, self).__init__()
+        self.compression = compression
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.nonfinite = 0
+        self.centroid_means = np.empty(0)
+        self.centroid_weights = np.empty(0)
+
+    def _add_moments(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count+count
+        delta = mean-self.mean
+        self.mean += delta*count/total
+        self.m2 += m2+delta**2*self.count*count/total
+        self.count = total
+
+    def _compress(self, means, weights):
+        '''merge adjacent centroids whose mid ranks fall in the same unit of
+            the scale function k(q) = compression/(2 pi) asin(2q - 1)
+        '''
+        order = np.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+        cum = np.cumsum(weights)
+        q = (cum-weights/2)/cum[-1]
+        k = self.compression/(2*np.pi)*np.arcsin(np.clip(2*q-1, -1, 1))
+        cluster = np.floor(k).astype(np.int64)
+        cluster -= cluster[0]
+        merged_weights = np.bincount(cluster, weights)
+        keep = merged_weights > 0
+        merged_means = np.bincount(cluster, weights*means)[keep]/merged_weights[keep]
+        self.centroid_means = merged_means
+        self.centroid_weights = merged_weights[keep]
+
+    def update(self, values):
+        '''add a chunk of values'''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        self.nonfinite += int(finite.size-finite.sum())
+        values = values[finite]
+        if values.size == 0:
+            return self
+        mean = values.mean()
+        self._add_moments(values.size, mean, ((values-mean)**2).sum())
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self._compress(np.concatenate([self.centroid_means, values]),
+                       np.concatenate([self.centroid_weights, np.ones(values.size)]))
+        return self
+
+    def merge(self, other):
+        '''add the values summarized by another StreamingSummary'''
+        self.nonfinite += other.nonfinite
+        if other.count == 0:
+            return self
+        self._add_moments(other.count, other.mean, other.m2)
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._compress(np.concatenate([self.centroid_means, other.centroid_means]),
+                       np.concatenate([self.centroid_weights, other.centroid_weights]))
+        return self
+
+    def std(self, ddof=1):
+        if self.count <= ddof:
+            return np.nan
+        return np.sqrt(self.m2/(self.count-ddof))
+
+    def quantile(self, q):
+        '''approximate quantiles, interpolated between the centroids (at
+            their mid ranks) and the minimum and maximum
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        weights = self.centroid_weights
+        mid = (np.cumsum(weights)-weights/2)/self.count
+        return np.interp(q, np.concatenate([[0], mid, [1]]),
+                         np.concatenate([[self.minimum], self.centroid_means, [self.maximum]]))
+
+    def median(self):
+        return float(self.quantile(0.5))
+
+
+def summarize_columns(values, columns, chunk_size=SUMMARY_CHUNK_SIZE,
+                      compression=DEFAULT_COMPRESSION):
+    '''StreamingSummary of each of the given columns of an (N, M) array,
+        by name ({name: column position}), fed chunk_size rows at a time
+    '''
+    summaries = {name: StreamingSummary(compression) for name in columns}
+    for start in range(0, values.shape[0], chunk_size):
+        chunk = values[start:start+chunk_size]
+        for name, i in columns.items():
+            summaries[name].update(chunk[:, i])
+    return summaries
+
+
+def merge_summaries(summaries):
+    '''merge a list of {name: StreamingSummary} into a new one'''
+    merged = {}
+    for summary in summaries:
+        for name, s in summary.items():
+            merged.setdefault(name, StreamingSummary(s.compression)).merge(s)
+    return merged
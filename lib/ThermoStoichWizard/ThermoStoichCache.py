@@ -0,0 +1,121 @@
+'''
+On-disk cache of thermo stoichiometry results keyed by chemical composition
+'''
+
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class ThermoStoichCache(object):
+    """LRU cache of the flat results of BatchThermoStoichiometry
+
+    Each entry holds the row returned by get_all_thermo_stoich for one CHNOPS
+    composition under one set of model parameters (T, pH, eta, delGsyn and
+    the biomass formula). Entries are kept in a sqlite database so they
+    survive across runs; once max_entries is exceeded the least recently
+    used entries are evicted.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000000
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        super(ThermoStoichCache, self).__init__()
+        self.path = path
+        self.max_entries = int(max_entries)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS thermo_stoich (
+            params TEXT NOT NULL,
+            composition BLOB NOT NULL,
+            value BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (params, composition))''')
+        self._conn.execute('''CREATE INDEX IF NOT EXISTS thermo_stoich_last_used
+            ON thermo_stoich (last_used)''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM thermo_stoich').fetchone()[0]
+
+    @staticmethod
+    def _params_key(params):
+        return json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def _composition_keys(chemical_composition):
+        chemical_composition = np.ascontiguousarray(chemical_composition, dtype=np.float64)
+        return [row.tobytes() for row in chemical_composition]
+
+    def lookup(self, params, chemical_composition):
+        '''look up the (N, 6) compositions under the given model parameters.
+            Returns the cached rows and the positions of the compositions
+            they belong to.
+        '''
+        params_key = self._params_key(params)
+        keys = self._composition_keys(chemical_composition)
+
+        cur = self._conn.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (pos INTEGER, composition BLOB)')
+        cur.execute('DELETE FROM lookup')
+        cur.executemany('INSERT INTO lookup VALUES (?, ?)', enumerate(keys))
+        cur.execute('''SELECT lookup.pos, thermo_stoich.value FROM lookup
+            JOIN thermo_stoich ON thermo_stoich.params = ?
+                AND thermo_stoich.composition = lookup.composition
+            ORDER BY lookup.pos''', (params_key,))
+        rows = cur.fetchall()
+        cur.execute('''UPDATE thermo_stoich SET last_used = ?
+            WHERE params = ? AND composition IN (SELECT composition FROM lookup)''',
+                    (time.time(), params_key))
+        cur.execute('DELETE FROM lookup')
+        self._conn.commit()
+
+        found = np.array([pos for pos, _ in rows], dtype=np.int64)
+        if len(rows) == 0:
+            return np.empty((0, 0)), found
+        values = np.frombuffer(b''.join(value for _, value in rows), dtype=np.float64)
+        return values.reshape(len(rows), -1), found
+
+    def store(self, params, chemical_composition, values):
+        '''add the (N, 6) compositions and their (N, M) result rows, then
+            evict the least recently used entries beyond max_entries
+        '''
+        params_key = self._params_key(params)
+        keys = self._composition_keys(chemical_composition)
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        now = time.time()
+
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO thermo_stoich VALUES (?, ?, ?, ?)',
+            ((params_key, key, value.tobytes(), now) for key, value in zip(keys, values)))
+        num_evict = len(self) - self.max_entries
+        if num_evict > 0:
+            self._conn.execute('''DELETE FROM thermo_stoich WHERE rowid IN
+                (SELECT rowid FROM thermo_stoich ORDER BY last_used LIMIT ?)''', (num_evict,))
+        self._conn.commit()
+
+
+@contextmanager
+def open_cache(config):
+    '''the ThermoStoichCache at config "thermo-cache-path", or None when no
+        path is set. The path has to outlive the job for entries to be
+        reused, the per-job scratch folder does not.
+    '''
+    path = config.get('thermo-cache-path')
+    if not path:
+        yield None
+        return
+    max_entries = config.get('thermo-cache-max-entries', ThermoStoichCache.DEFAULT_MAX_ENTRIES)
+    with ThermoStoichCache(path, max_entries=max_entries) as cache:
+        yield cache
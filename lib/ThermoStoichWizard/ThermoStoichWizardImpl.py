@@ -3,8 +3,8 @@
 import logging
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pandas as pd
 
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -13,8 +13,15 @@ from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.fba_toolsClient import fba_tools
 
-from ThermoStoichWizard.ThermoStoichiometry import ThermoStoichiometry, FTICRResult
+from ThermoStoichWizard.ThermoStoichiometry import (BatchThermoStoichiometry, FTICRResult,
+                                                    write_table, CHEMICAL_ELEMENTS,
+                                                    MAX_VAN_KREVELEN_POINTS)
+from ThermoStoichWizard.ThermoStoichCache import open_cache
 from ThermoStoichWizard.LambdaAnalysis import LambdaAnalysis
+from ThermoStoichWizard.BatchAnalysis import BatchAnalysis
+from ThermoStoichWizard.StageTimer import StageTimer
+from ThermoStoichWizard.LambdaUncertainty import LambdaUncertainty
+from ThermoStoichWizard.DistributionSketch import save_sketches
 
 #END_HEADER
 
@@ -39,6 +46,185 @@ class ThermoStoichWizard:
     GIT_COMMIT_HASH = "1c3776e6e16251db8a131ca5a9397b0c746588c2"
 
     #BEGIN_CLASS_HEADER
+    @staticmethod
+    def _thermo_conditions(params):
+        '''T, pH, eta and delGsyn given in the params. Each is a number or
+            comma separated numbers, one per scenario (a single number is used
+            for all scenarios). Returns arrays of the same length.
+        '''
+        conditions = {}
+        for name in BatchThermoStoichiometry.CONDITIONS:
+            if str(params.get(name, '')).strip():
+                conditions[name] = np.array([float(v) for v in str(params[name]).split(',')])
+        try:
+            arrays = np.broadcast_arrays(*conditions.values())
+        except ValueError:
+            raise ValueError('Thermodynamic conditions must have the same number of values: {}'
+                             .format({k: v.tolist() for k, v in conditions.items()}))
+        return dict(zip(conditions, arrays))
+
+    def _save_result_tables(self, fticr, sample, new_comp, new_fticr, output_format,
+                            scenarios=None, uncertainty=None, stoich_matrices=False):
+        '''write the result tables, returns the file links for the report'''
+        output_folder = os.path.join(self.shared_folder, 'csv')
+        os.mkdir(output_folder)
+        tables = ["stoichMet_O2", "thermodynamic_props"]
+        if stoich_matrices:
+            # opt-in: "stoichD","stoichA","stoichCat","stoichAn_O2","stoichAn_HCO3",
+            # "stoichMet_O2","stoichMet_HCO3" all in one long table
+            tables.append("stoich_matrices")
+        result_paths = fticr.save_result_files(output_folder, fmt=output_format, tables=tables)
+        output_files = [{
+                'path': path,
+                'name': os.path.basename(path),
+                'label': n, 'description': n
+            } for n, path in result_paths.items()]
+
+        # mergeable histograms for comparisons across samples and runs
+        sketches_path = os.path.join(output_folder, "distribution_sketches.json")
+        save_sketches(sketches_path, {sample: fticr.distribution_sketches()})
+        output_files.append({'path': sketches_path,
+                             'name': os.path.basename(sketches_path),
+                             'label': 'distribution sketches',
+                             'description': 'histograms of lambda_O2, lambda_HCO3 '
+                                            'and delGcox0PerC'})
+
+        average_comp_path = write_table(new_comp,
+                                        os.path.join(output_folder, "avg_comp_from_lambda_bins"),
+                                        fmt=output_format)
+        output_files.append({'path': average_comp_path,
+                             'name': os.path.basename(average_comp_path),
+                             'label': 'average compositions for each lambda bin',
+                             'description': 'average compositions for each lambda bin'})
+
+        selected_folder = os.path.join(self.shared_folder, 'bin_avg')
+        os.mkdir(selected_folder)
+        result_paths = new_fticr.save_result_files(selected_folder, fmt=output_format,
+                                                   tables=["stoichMet_O2"])
+        output_files += [{
+            'path': path,
+            'name': '{}_from_lambda_bins{}'.format(n, os.path.splitext(path)[1]),
+            'label': '{}_from_lambda_bins'.format(n),
+            'description': '{}_from_lambda_bins'.format(n),
+        } for n, path in result_paths.items()]
+
+        if scenarios is not None:
+            scenarios_path = write_table(scenarios, os.path.join(output_folder, "thermo_scenarios"),
+                                         fmt=output_format, index=False)
+            output_files.append({'path': scenarios_path,
+                                 'name': os.path.basename(scenarios_path),
+                                 'label': 'thermodynamic properties for each scenario',
+                                 'description': 'thermodynamic properties for each scenario'})
+
+        if uncertainty is not None:
+            peak_summary, bin_shifts = uncertainty
+            summary_path = write_table(peak_summary,
+                                       os.path.join(output_folder, "lambda_uncertainty"),
+                                       fmt=output_format)
+            output_files.append({'path': summary_path,
+                                 'name': os.path.basename(summary_path),
+                                 'label': 'lambda uncertainty for each peak',
+                                 'description': 'lambda mean, std and quantiles for each peak'})
+            shifts_path = write_table(bin_shifts, os.path.join(output_folder, "lambda_bin_shifts"),
+                                      fmt=output_format, index=False)
+            output_files.append({'path': shifts_path,
+                                 'name': os.path.basename(shifts_path),
+                                 'label': 'shifts of the lambda bin averages',
+                                 'description': 'shifts of the lambda bin averages '
+                                                'under the uncertainty'})
+        return output_files
+
+    def _generate_fbamodel(self, fticr, prefix, stoich, model_prefix, params):
+        '''create the tsv files for fba and upload them as an FBA model'''
+        fticr.create_fba_model_files(self.shared_folder, prefix=prefix)
+        # every branch has its own client, they are not shared across threads
+        fbaobj = fba_tools(self.callback_url)
+        fba_param = {
+            # 'model_name':'model' + params['output_surfix'],
+            'file_type': 'tsv',
+            'compounds_file': {
+                'path': os.path.join(self.shared_folder, "{}_comps.tsv".format(prefix))},
+            'model_file': {
+                'path': os.path.join(self.shared_folder, "{}_{}.tsv".format(prefix, stoich))},
+            'biomass': ['xrxn1_c0'],  # TODO: how to define a biomass reaction
+            'model_name': "{}_{}".format(model_prefix, params['output_surfix']),
+            'workspace_name': params['workspace_name']
+        }
+        fba_model_wref = fbaobj.tsv_file_to_model(p=fba_param)
+        print('fba_model:', fba_model_wref)
+        return {'ref': fba_model_wref['ref'], 'description': "FBA model for {}".format(stoich)}
+
+    def _plot_figures(self, fticr, new_comp, html_folder, max_plot_points=MAX_VAN_KREVELEN_POINTS):
+        '''draw the report figures one after another (pyplot is not thread
+            safe), returns the file links and whether the van Krevelen
+            diagrams were drawn
+        '''
+        output_files = []
+        if "Class" in fticr._assigned_tbl.columns:
+            van_krevelen_available = True
+        else:
+            van_krevelen_available = False
+
+        if van_krevelen_available:
+            van_krevelen_path = os.path.join(html_folder, "van_krevelen.png")
+            # at most max_plot_points compounds are drawn, the limits cover all
+            g1 = fticr.plot_van_krevelen(van_krevelen_path, max_points=max_plot_points,
+                                         figsize=(7, 5), legend_fontsize=10)
+
+            van_krevelen_lambda_bins_path = os.path.join(html_folder,
+                                                         "van_krevelen_by_lambda_bins.png")
+            plt.figure(figsize=(7, 5))
+            # new_comp is written out by another branch, draw from a copy
+            new_comp = new_comp.copy()
+            new_comp["H:C"] = new_comp.H / new_comp.C
+            new_comp["O:C"] = new_comp.O / new_comp.C
+            g = sns.scatterplot(x="O:C", y="H:C", hue="Class", s=100, data=new_comp)
+            g.set_xlabel("O:C", fontsize=15)
+            g.set_ylabel("H:C", fontsize=15)
+            g.set_xlim(g1.get_xlim())
+            g.set_ylim(g1.get_ylim())
+            plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left", fontsize=12)
+            plt.tight_layout()
+            # plt.savefig(van_krevelen_path)
+            plt.savefig(van_krevelen_lambda_bins_path)
+
+        lambda_dist_path = os.path.join(html_folder, "lambda_dist.png")
+        fticr.plot_lambda_dist(fout=lambda_dist_path)
+        # delGcat0_dist_path = os.path.join(html_folder, "delGcat0_dist.png")
+        # fticr.plot_delta_gibb_dist('delGcat0', r'$\Delta G_{Cox}^0$', delGcat0_dist_path)
+        # delGcat_dist_path = os.path.join(html_folder, "delGcat_dist.png")
+        # fticr.plot_delta_gibb_dist('delGcat', r'$\Delta G_{Cox}$', delGcat_dist_path)
+        delGcox0_dist_path = os.path.join(html_folder, "delGcox0_dist.png")
+        fticr.plot_delta_gibb_dist('delGcox0PerC', r'$\Delta G_{Cox}^0$', delGcox0_dist_path)
+        # delGcox_dist_path = os.path.join(html_folder, "delGcox_dist.png")
+        # fticr.plot_delta_gibb_dist('delGcox', r'$\Delta G_{Cox}$', delGcox_dist_path)
+
+        if van_krevelen_available:
+            output_files.append({'path': van_krevelen_path, 'name': 'van_krevelen.png',
+                                 'label': 'van Krevelen diagram for compounds',
+                                 'description': 'van Krevelen diagram for compounds'})
+            output_files.append({'path': van_krevelen_lambda_bins_path,
+                                 'name': 'van_krevelen_by_lambda_bins.png',
+                                 'label': 'van Krevelen diagram for each lambda bin',
+                                 'description': 'van Krevelen diagram for each lambda bin'})
+
+        output_files.append({'path': lambda_dist_path, 'name': 'lambda_dist.png',
+                             'label': 'lambda distribution', 'description': 'lambda distribution'})
+        # output_files.append({'path': delGcat0_dist_path, 'name': 'delGcat0_dist.png',
+        #     'label': 'delGcat0 distribution',
+        #     'description': 'Gibbs free energy change for an electron donor half reaction'})
+        # output_files.append({'path': delGcat_dist_path, 'name': 'delGcat_dist.png',
+        #     'label': 'delGcat distribution',
+        #     'description': 'Gibbs free energy change for catabolic reaction'})
+        output_files.append({'path': delGcox0_dist_path, 'name': 'delGcox0_dist.png',
+                             'label': 'delGcox0 distribution',
+                             'description': 'Gibbs energies for the oxidation half reactions'})
+        # output_files.append({'path': delGcox_dist_path, 'name': 'delGcox_dist.png',
+        #     'label': 'delGcox distribution',
+        #     'description': 'Gibbs energies for the oxidation half reactions'})
+        plt.close('all')
+        return output_files, van_krevelen_available
+
     #END_CLASS_HEADER
 
     # config contains contents of config file in a hash or None if it couldn't
@@ -52,6 +238,7 @@ class ThermoStoichWizard:
                             level=logging.INFO)
 
         self.lambda_analysis = LambdaAnalysis(self.config)
+        self.batch_analysis = BatchAnalysis(self.config)
         #END_CONSTRUCTOR
         pass
 
@@ -60,27 +247,48 @@ class ThermoStoichWizard:
         """
         This example function accepts any number of parameters and returns results in a KBaseReport
         :param params: instance of mapping from String to unspecified object
-        :returns: instance of type "ReportResults" -> structure: parameter
-           "report_name" of String, parameter "report_ref" of String
+        :returns: instance of type "ReportResults" (performance - wall time,
+           CPU time and peak memory of each stage of the method) ->
+           structure: parameter "report_name" of String, parameter
+           "report_ref" of String, parameter "performance" of list of type
+           "StageTiming" (wall_time, cpu_time - seconds peak_rss_delta -
+           increase of the peak resident memory in MB) -> structure:
+           parameter "stage" of String, parameter "wall_time" of Double,
+           parameter "cpu_time" of Double, parameter "peak_rss_delta" of
+           Double
         """
         # ctx is the context object
         # return variables are: output
         #BEGIN run_ThermoStoichWizard
         
         uuid_string = str(uuid.uuid4())
-        objects_created = []
-        output_files = []
+        timer = StageTimer(ctx)
 
         n_lambda_bins = int(params['n_lambda_bins'])
         lambda_cutoff = float(params['lambda_cutoff'])
+        # opt-in: number of processes computing the thermodynamics
+        workers = int(params.get('workers', 1))
+        output_format = params.get('output_format', 'csv')
+        # thermodynamic conditions: the first scenario drives the lambda bins
+        # and models, all of them are reported in "thermo_scenarios"
+        conditions = self._thermo_conditions(params)
+        model_params = {name: values[0] for name, values in conditions.items()}
+        num_scenarios = max([len(values) for values in conditions.values()] + [1])
+        # opt-in: all seven stoichiometry matrices in one "stoich_matrices" table
+        stoich_matrices = bool(int(params.get('stoich_matrices', 0) or 0))
+        # opt-in: Monte-Carlo samples of eta and delGsyn for the lambda uncertainty
+        uncertainty_samples = int(params.get('uncertainty_samples', 0) or 0)
+        max_plot_points = int(params.get('max_plot_points', MAX_VAN_KREVELEN_POINTS))
 
         
         #######################################################################
         #  check out the input table
         #######################################################################
         print ("Input parameter", params['input_tbl'])
-        dfu = DataFileUtil(self.callback_url)
-        input_tbl = dfu.get_objects({'object_refs': [params['input_tbl']]})['data'][0]
+        with timer.stage('fetch input object'):
+            dfu = DataFileUtil(self.callback_url)
+            input_tbl = dfu.get_objects({'object_refs': [params['input_tbl']]})['data'][0]
+        sample = input_tbl['info'][1]
 
         # # investigate input_tbl
         # for peak in input_tbl['data']['instances']:
@@ -88,27 +296,26 @@ class ThermoStoichWizard:
         #     break
         # print(input_tbl['info'])
 
-        tbl_cols = [info['attribute'] for info in input_tbl['data']['attributes']]
-        tbl_df = pd.DataFrame.from_dict(input_tbl['data']['instances'], orient='index', columns=tbl_cols)
-
         #######################################################################
         #  compute thermo stoichiometry
         #######################################################################
-        fticr = FTICRResult(tbl_df)
-        fticr.to_csv(os.path.join(self.shared_folder, "input_compounds.csv"))
-
-        fticr.run()
-        output_folder = os.path.join(self.shared_folder, 'csv')
-        os.mkdir(output_folder)
-        fticr.save_result_files(output_folder)
-        # output_filenames = ["stoichD","stoichA","stoichCat","stoichAn_O2","stoichAn_HCO3","stoichMet_O2","stoichMet_HCO3","thermodynamic_props"]
-        output_filenames = ["stoichMet_O2","thermodynamic_props"]
-        output_files = [{
-                'path': output_folder+'/{}.csv'.format(n),
-                'name': '{}.csv'.format(n),
-                'label': n, 'description': n
-            } for n in output_filenames]
-
+        with timer.stage('formula assignment'):
+            fticr = FTICRResult.from_attribute_mapping(input_tbl['data'])
+            # the table in fticr is all we need from the object
+            del input_tbl
+        with timer.stage('write input compounds'):
+            fticr.to_csv(os.path.join(self.shared_folder, "input_compounds.csv"))
+
+        # off unless "thermo-cache-path" is configured
+        with timer.stage('thermo computation'), open_cache(self.config) as cache:
+            fticr.run(cache=cache, workers=workers, model_params=model_params)
+            cache_stats = 'off' if cache is None else \
+                '{}/{}'.format(fticr.cache_hits, fticr.cache_misses)
+        print('cache hits:{}, cache misses:{}'.format(fticr.cache_hits, fticr.cache_misses))
+        scenarios = None
+        if num_scenarios > 1:
+            with timer.stage('thermo scenarios'):
+                scenarios = fticr.scenario_thermo(**conditions)
         # filter out the unassigned peaks
         num_peaks = fticr.num_peaks
         num_cpds = fticr.num_cpds
@@ -118,75 +325,64 @@ class ThermoStoichWizard:
         #######################################################################
         #  average compositions by lambda bins
         #######################################################################
-        if params['bin_method'] == "cumulative":
-            new_comp = fticr.average_by_lambda_bins(n_bins=n_lambda_bins, cutoff=lambda_cutoff)
-        elif params['bin_method'] == "uniform":
-            new_comp = fticr.average_by_lambda_bins_uniform(n_bins=n_lambda_bins, cutoff=lambda_cutoff)
-        else:
-            raise("bin_method was wrong:", params['bin_method'])
-        average_comp_path = os.path.join(output_folder, "avg_comp_from_lambda_bins.csv")
-        new_comp.to_csv(average_comp_path)
-
-        output_files.append({'path': average_comp_path,
-                            'name': 'avg_comp_from_lambda_bins.csv',
-                            'label': 'average compositions for each lambda bin',
-                            'description': 'average compositions for each lambda bin'})
+        with timer.stage('lambda binning'):
+            if params['bin_method'] == "cumulative":
+                new_comp = fticr.average_by_lambda_bins(n_bins=n_lambda_bins, cutoff=lambda_cutoff)
+            elif params['bin_method'] == "uniform":
+                new_comp = fticr.average_by_lambda_bins_uniform(n_bins=n_lambda_bins,
+                                                                cutoff=lambda_cutoff)
+            else:
+                raise Exception("bin_method was wrong: {}".format(params['bin_method']))
+
+        uncertainty = None
+        if uncertainty_samples > 0:
+            with timer.stage('lambda uncertainty'):
+                # Formularity keeps only the number of candidates, so each
+                # peak has its assigned formula as the single candidate
+                lambda_uncertainty = LambdaUncertainty(fticr._assigned_tbl[CHEMICAL_ELEMENTS],
+                                                       model_params=fticr.model_params)
+                eta_sd = float(params.get('eta_sd', 0.05))
+                delGsyn_sd = float(params.get('delGsyn_sd', 20))
+                lambda_uncertainty.run(n_samples=uncertainty_samples, eta_sd=eta_sd,
+                                       delGsyn_sd=delGsyn_sd)
+                uncertainty = (lambda_uncertainty.peak_summary(),
+                               lambda_uncertainty.bin_shifts(n_lambda_bins, lambda_cutoff,
+                                                             params['bin_method']))
 
         # compute the reactions for bin averaged compositions
-        new_fticr = FTICRResult(new_comp, dtype=np.float)
+        with timer.stage('bin averaged thermo computation'):
+            new_fticr = FTICRResult.from_compositions(new_comp, model_params=model_params)
 
-        new_fticr.run()
-        selected_folder = os.path.join(self.shared_folder, 'bin_avg')
-        os.mkdir(selected_folder)
-        new_fticr.save_result_files(selected_folder)
-        output_filenames = ["stoichMet_O2"]
-        output_files += [{
-            'path': selected_folder+'/{}.csv'.format(n),
-            'name': '{}_from_lambda_bins.csv'.format(n),
-            'label': '{}_from_lambda_bins'.format(n),
-            'description': '{}_from_lambda_bins'.format(n),
-        } for n in output_filenames]
-
-        #######################################################################
-        #  create the tsv files for fba
-        #######################################################################
-        fticr.create_fba_model_files(self.shared_folder)
-        new_fticr.create_fba_model_files(self.shared_folder, prefix='bin_avg')
+        html_folder = os.path.join(self.shared_folder, 'html')
+        os.mkdir(html_folder)
 
         #######################################################################
-        #  generate fbamodel
+        #  result tables, fba models and figures do not depend on each other
         #######################################################################
-        fbaobj = fba_tools(self.callback_url)
-        def generate_fbamodel(fbaobj, model_prefix, workspace_name, compounds_file, reactions_file):
-            fba_param = {
-                # 'model_name':'model' + params['output_surfix'],
-                'file_type':'tsv',
-                'compounds_file':{'path': compounds_file},
-                'model_file':{'path': reactions_file},
-                'biomass':['xrxn1_c0'],  # TODO: how to define a biomass reaction
-                'model_name': "{}_{}".format(model_prefix, params['output_surfix']),
-                'workspace_name': workspace_name # 
-            }
-            fba_model_wref = fbaobj.tsv_file_to_model(p=fba_param)
-            print('fba_model:', fba_model_wref)
-            return fba_model_wref
-
         # stoichiometries = ["stoichD","stoichA","stoichCat","stoichAn_O2","stoichAn_HCO3","stoichMet_O2","stoichMet_HCO3"]
         stoichiometries = ["stoichMet_O2"]
-        for stoich in stoichiometries:
-            fba_model_wref = generate_fbamodel(fbaobj, model_prefix=stoich,
-                workspace_name=params['workspace_name'],
-                compounds_file=os.path.join(self.shared_folder, "temp_comps.tsv"),
-                reactions_file=os.path.join(self.shared_folder, "temp_{}.tsv".format(stoich)))
-            objects_created.append({'ref': fba_model_wref['ref'],
-                'description': "FBA model for {}".format(stoich)})
-
-            fba_model_wref = generate_fbamodel(fbaobj, model_prefix="Bin_Averaged_"+stoich,
-                workspace_name=params['workspace_name'],
-                compounds_file=os.path.join(self.shared_folder, "bin_avg_comps.tsv"),
-                reactions_file=os.path.join(self.shared_folder, "bin_avg_{}.tsv".format(stoich)))
-            objects_created.append({'ref': fba_model_wref['ref'],
-                'description': "FBA model for {}".format(stoich)})
+        with timer.stage('concurrent outputs'), \
+                ThreadPoolExecutor(max_workers=2 + 2 * len(stoichiometries)) as executor:
+            tables_future = executor.submit(timer.wrap('result tables', self._save_result_tables),
+                                            fticr, sample, new_comp, new_fticr, output_format,
+                                            scenarios, uncertainty, stoich_matrices)
+            model_futures = []
+            for stoich in stoichiometries:
+                model_futures.append(executor.submit(
+                    timer.wrap('FBA model {}'.format(stoich), self._generate_fbamodel),
+                    fticr, 'temp', stoich, stoich, params))
+                model_futures.append(executor.submit(
+                    timer.wrap('FBA model Bin_Averaged_{}'.format(stoich), self._generate_fbamodel),
+                    new_fticr, 'bin_avg', stoich, "Bin_Averaged_"+stoich, params))
+            figures_future = executor.submit(timer.wrap('figures', self._plot_figures),
+                                             fticr, new_comp, html_folder, max_plot_points)
+
+            # the report needs every branch, so wait for all of them
+            output_files = tables_future.result()
+            objects_created = [f.result() for f in model_futures]
+            figure_files, van_krevelen_available = figures_future.result()
+        output_files += figure_files
+
         #######################################################################
         #  create the tsv files for media
         #######################################################################
@@ -210,80 +406,6 @@ class ThermoStoichWizard:
         #######################################################################
         # html report
         #######################################################################
-        html_folder = os.path.join(self.shared_folder, 'html')
-        os.mkdir(html_folder)
-
-        #######################################################################
-        # figures
-        #######################################################################
-        if "Class" in fticr._assigned_tbl.columns:
-            van_krevelen_available = True
-        else:
-            van_krevelen_available = False
-
-        if van_krevelen_available:
-            van_krevelen_path = os.path.join(html_folder, "van_krevelen.png")
-            # fticr.plot_van_krevelen(fout=van_krevelen_path)
-            
-            # fig, ax = plt.subplots(1,2,figsize=(12,6),sharex=True,sharey=True)
-            plt.figure(figsize=(7,5))
-            df = fticr._assigned_tbl.copy()
-            
-            df["H:C"] = df.H / df.C
-            df["O:C"] = df.O / df.C
-
-            g1 = sns.scatterplot("O:C", "H:C", hue="Class", alpha=1, s=15, data=df)
-            g1.set_xlabel("O:C", fontsize=15)
-            g1.set_ylabel("H:C", fontsize=15)
-            plt.legend(bbox_to_anchor=(1.04,1), loc="upper left", fontsize=10)
-            plt.tight_layout()
-            plt.savefig(van_krevelen_path)
-
-            van_krevelen_lambda_bins_path = os.path.join(html_folder, "van_krevelen_by_lambda_bins.png")
-            plt.figure(figsize=(7,5))
-            new_comp["H:C"] = new_comp.H / new_comp.C
-            new_comp["O:C"] = new_comp.O / new_comp.C
-            g = sns.scatterplot("O:C", "H:C", hue="Class", s=100, data=new_comp)
-            g.set_xlabel("O:C", fontsize=15)
-            g.set_ylabel("H:C", fontsize=15)
-            g.set_xlim(g1.get_xlim())
-            g.set_ylim(g1.get_ylim())
-            plt.legend(bbox_to_anchor=(1.04,1), loc="upper left", fontsize=12)
-            plt.tight_layout()
-            # plt.savefig(van_krevelen_path)
-            plt.savefig(van_krevelen_lambda_bins_path)
-
-        lambda_dist_path = os.path.join(html_folder, "lambda_dist.png")
-        fticr.plot_lambda_dist(fout=lambda_dist_path)
-        # delGcat0_dist_path = os.path.join(html_folder, "delGcat0_dist.png")
-        # fticr.plot_delta_gibb_dist('delGcat0', r'$\Delta G_{Cox}^0$', delGcat0_dist_path)
-        # delGcat_dist_path = os.path.join(html_folder, "delGcat_dist.png")
-        # fticr.plot_delta_gibb_dist('delGcat', r'$\Delta G_{Cox}$', delGcat_dist_path)
-        delGcox0_dist_path = os.path.join(html_folder, "delGcox0_dist.png")
-        fticr.plot_delta_gibb_dist('delGcox0PerC', r'$\Delta G_{Cox}^0$', delGcox0_dist_path)
-        # delGcox_dist_path = os.path.join(html_folder, "delGcox_dist.png")
-        # fticr.plot_delta_gibb_dist('delGcox', r'$\Delta G_{Cox}$', delGcox_dist_path)
-
-        if van_krevelen_available:
-            output_files.append({'path': van_krevelen_path, 'name': 'van_krevelen.png',
-                'label': 'van Krevelen diagram for compounds', 'description': 'van Krevelen diagram for compounds'})
-            output_files.append({'path': van_krevelen_lambda_bins_path, 'name': 'van_krevelen_by_lambda_bins.png',
-                'label': 'van Krevelen diagram for each lambda bin', 'description': 'van Krevelen diagram for each lambda bin'})
-
-        output_files.append({'path': lambda_dist_path, 'name': 'lambda_dist.png',
-            'label': 'lambda distribution', 'description': 'lambda distribution'})
-        # output_files.append({'path': delGcat0_dist_path, 'name': 'delGcat0_dist.png',
-        #     'label': 'delGcat0 distribution',
-        #     'description': 'Gibbs free energy change for an electron donor half reaction'})
-        # output_files.append({'path': delGcat_dist_path, 'name': 'delGcat_dist.png',
-        #     'label': 'delGcat distribution', 'description': 'Gibbs free energy change for catabolic reaction'})
-        output_files.append({'path': delGcox0_dist_path, 'name': 'delGcox0_dist.png',
-            'label': 'delGcox0 distribution',
-            'description': 'Gibbs energies for the oxidation half reactions'})
-        # output_files.append({'path': delGcox_dist_path, 'name': 'delGcox_dist.png',
-        #     'label': 'delGcox distribution',
-        #     'description': 'Gibbs energies for the oxidation half reactions'})
-
         summary_str = '<ul class="list-group list-group-flush">'
         summary_str += '<li class="list-group-item">Average: {:.3f}</li>'
         summary_str += '<li class="list-group-item">Standard deviation: {:.3f}</li>'
@@ -339,34 +461,54 @@ class ThermoStoichWizard:
             html_str += '</div>'
             html_str += '</div>'
 
+        if uncertainty is not None:
+            html_str += '<div class="col-md-12">'
+            html_str += '<p>Lambda uncertainty: {} Monte-Carlo samples of eta (sd {:g}) ' \
+                'and delGsyn (sd {:g}). '.format(uncertainty_samples, eta_sd, delGsyn_sd)
+            html_str += 'The input keeps only the number of candidate formulas, so each peak has '
+            html_str += 'its assigned formula as the only candidate and the formula ambiguity '
+            html_str += 'is not included.</p>'
+            html_str += '</div>'
+
         with open(os.path.join(os.path.dirname(__file__), 'templates', 'template.html'),
                   'r') as template_file:
             report_html = template_file.read()
             report_html = report_html.replace('Number of peaks:', 'Number of peaks: {}'.format(num_peaks))
             report_html = report_html.replace('Number of compounds:', 'Number of compounds: {}'.format(num_cpds))
+            conditions_str = 'T={T:g} K, pH={pH:g}, eta={eta:g}, delGsyn={delGsyn:g} kJ/mol X'\
+                .format(**fticr.model_params)
+            if num_scenarios > 1:
+                conditions_str += ' ({} scenarios)'.format(num_scenarios)
+            report_html = report_html.replace('Thermodynamic conditions:',
+                                              'Thermodynamic conditions: ' + conditions_str)
+            report_html = report_html.replace('Thermodynamic cache (hits/misses):',
+                                              'Thermodynamic cache (hits/misses): ' + cache_stats)
             report_html = report_html.replace('<!--[Results]-->', html_str)
+            report_html = report_html.replace('<!--[Performance]-->', timer.to_html())
             
         with open(os.path.join(html_folder, "index.html"), 'w') as index_file:
             index_file.write(report_html)
 
-        report = KBaseReport(self.callback_url)
-        html_dir = {
-            'path': html_folder,
-            'name': 'index.html',  # MUST match the filename of your main html page
-            'description': 'Thermo Stoich Wizard Report'
-        }
-        report_info = report.create_extended_report({
-            'objects_created': objects_created,
-            'file_links': output_files,
-            'html_links': [html_dir],
-            'direct_html_link_index': 0,
-            'report_object_name': 'thermo_stoich_wizard_report_' + params['output_surfix'],
-            'workspace_name': params['workspace_name']
-        })
+        with timer.stage('report'):
+            report = KBaseReport(self.callback_url)
+            html_dir = {
+                'path': html_folder,
+                'name': 'index.html',  # MUST match the filename of your main html page
+                'description': 'Thermo Stoich Wizard Report'
+            }
+            report_info = report.create_extended_report({
+                'objects_created': objects_created,
+                'file_links': output_files,
+                'html_links': [html_dir],
+                'direct_html_link_index': 0,
+                'report_object_name': 'thermo_stoich_wizard_report_' + params['output_surfix'],
+                'workspace_name': params['workspace_name']
+            })
         
         output = {
             'report_name': report_info['name'],
             'report_ref': report_info['ref'],
+            'performance': timer.to_list(),
         }
         #END run_ThermoStoichWizard
 
@@ -377,21 +519,75 @@ class ThermoStoichWizard:
         # return the results
         return [output]
 
+    def run_ThermoStoichWizard_batch(self, ctx, params):
+        """
+        run_ThermoStoichWizard_batch: run_ThermoStoichWizard for many samples in one job
+        :param params: instance of type "BatchParams" (input_tbls - FTICR
+           AttributeMappings, one per sample T, pH, eta, delGsyn - a single
+           set of thermodynamic conditions) -> structure: parameter
+           "input_tbls" of list of type "obj_ref" (An X/Y/Z style
+           reference), parameter "n_lambda_bins" of Long, parameter
+           "lambda_cutoff" of Double, parameter "bin_method" of String,
+           parameter "output_format" of String, parameter "workers" of Long,
+           parameter "T" of String, parameter "pH" of String, parameter "eta"
+           of String, parameter "delGsyn" of String, parameter
+           "workspace_name" of String, parameter "output_surfix" of String
+        :returns: instance of type "ReportResults" (performance - wall time,
+           CPU time and peak memory of each stage of the method) ->
+           structure: parameter "report_name" of String, parameter
+           "report_ref" of String, parameter "performance" of list of type
+           "StageTiming" (wall_time, cpu_time - seconds peak_rss_delta -
+           increase of the peak resident memory in MB) -> structure:
+           parameter "stage" of String, parameter "wall_time" of Double,
+           parameter "cpu_time" of Double, parameter "peak_rss_delta" of
+           Double
+        """
+        # ctx is the context object
+        # return variables are: output
+        #BEGIN run_ThermoStoichWizard_batch
+        conditions = self._thermo_conditions(params)
+        if max([len(values) for values in conditions.values()] + [1]) > 1:
+            raise ValueError('run_ThermoStoichWizard_batch takes a single set of '
+                             'thermodynamic conditions: {}'
+                             .format({k: v.tolist() for k, v in conditions.items()}))
+        model_params = {name: values[0] for name, values in conditions.items()}
+        output = self.batch_analysis.run(params, ctx=ctx, model_params=model_params)
+        #END run_ThermoStoichWizard_batch
+
+        # At some point might do deeper type checking...
+        if not isinstance(output, dict):
+            raise ValueError('Method run_ThermoStoichWizard_batch return value ' +
+                             'output is not type dict as required.')
+        # return the results
+        return [output]
+
     def run_lambda_analysis(self, ctx, params):
         """
         run_lambda_analysis: perform lambda analysis
-        :param params: instance of type "LambdaParams" -> structure:
-           parameter "lambda_tbl" of type "obj_ref" (An X/Y/Z style
-           reference), parameter "stoich_tbl" of type "obj_ref" (An X/Y/Z
-           style reference), parameter "vh_cs" of String, parameter "vh_o2"
-           of String, parameter "workspace_name" of String
-        :returns: instance of type "ReportResults" -> structure: parameter
-           "report_name" of String, parameter "report_ref" of String
+        :param params: instance of type "LambdaParams" (correlation_plots -
+           "all" (default), "none" or comma separated "vh_cs:vh_o2" grid
+           cells max_plot_points - largest number of compounds drawn in each
+           correlation plot plot_workers - number of processes drawing the
+           correlation plots) -> structure: parameter "lambda_tbl" of type
+           "obj_ref" (An X/Y/Z style reference), parameter "stoich_tbl" of
+           type "obj_ref" (An X/Y/Z style reference), parameter "vh_cs" of
+           String, parameter "vh_o2" of String, parameter "workspace_name" of
+           String, parameter "correlation_plots" of String, parameter
+           "max_plot_points" of Long, parameter "plot_workers" of Long
+        :returns: instance of type "ReportResults" (performance - wall time,
+           CPU time and peak memory of each stage of the method) ->
+           structure: parameter "report_name" of String, parameter
+           "report_ref" of String, parameter "performance" of list of type
+           "StageTiming" (wall_time, cpu_time - seconds peak_rss_delta -
+           increase of the peak resident memory in MB) -> structure:
+           parameter "stage" of String, parameter "wall_time" of Double,
+           parameter "cpu_time" of Double, parameter "peak_rss_delta" of
+           Double
         """
         # ctx is the context object
         # return variables are: output
         #BEGIN run_lambda_analysis
-        output = self.lambda_analysis.run(params)
+        output = self.lambda_analysis.run(params, ctx=ctx)
         #END run_lambda_analysis
 
         # At some point might do deeper type checking...
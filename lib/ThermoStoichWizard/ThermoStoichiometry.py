@@ -10,12 +10,46 @@ import seaborn as sns
 
 import re
 import os
+import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from ThermoStoichWizard.DistributionSketch import DistributionSketch, SKETCH_EDGES, SKETCH_COLUMNS
+from ThermoStoichWizard.StreamingSummary import summarize_columns
 
 # CHNOPS chemical elements
 CHEMICAL_ELEMENTS = ["C","H","N","O","P","S"]
 # TODO: how to use Candidates
 REQUIRED_COLUMNS = CHEMICAL_ELEMENTS#+['Candidates']
 
+# stoichiometry matrices in the order they are stored in ThermoStoichTables
+STOICH_NAMES = ["stoichD", "stoichA", "stoichCat", "stoichAn_O2", "stoichAn_HCO3",
+                "stoichMet_O2", "stoichMet_HCO3"]
+# [eD,h2o,hco3-,nh4+,hpo4**2-,hs-,h+,e-,eA,biom]
+STOICH_COLNAMES = ["donor", "h2o", "hco3", "nh4", "hpo4", "hs", "h", "e", "acceptor", "biom"]
+# delGf0 (kJ/mol) of STOICH_COLNAMES, the donor's is estimated per compound
+DELTA_GF0_ZERO = np.array([0, -237.2, -586.9, -79.5, -1089.1, 12.0, 0, 0, 16.5, -67])
+# gas constant, kJ/(K.mol)
+R_GAS = 0.008314
+# proton column of STOICH_COLNAMES
+I_PROTON = STOICH_COLNAMES.index("h")
+# output formats of the result tables and their file extensions
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+# tables written by FTICRResult.save_result_files by default
+RESULT_TABLES = ["stoichMet_O2", "thermodynamic_props"]
+
+# AttributeMapping attributes converted to numbers by FTICRResult.from_attribute_mapping
+NUMERIC_ATTRIBUTES = CHEMICAL_ELEMENTS+['C13', 'Na']
+# number of AttributeMapping instances converted at a time
+INSTANCE_CHUNK_SIZE = 10000
+# default cap on the compounds drawn in a van Krevelen diagram
+MAX_VAN_KREVELEN_POINTS = 20000
+
+THERMO_COLNAMES = ["delGcox0PerC", "delGcox0", "delGcox", "delGcat0", "delGcat", "delGan0_O2",
+                   "delGan0_HCO3", "delGan_O2", "delGan_HCO3", "delGdis_O2", "delGdis_HCO3",
+                   "lambda_O2", "lambda_HCO3"]
+
 class FTICRResult(object):
     """FTICR Result"""
     def __init__(self, tbl, dtype=np.int):
@@ -25,17 +59,104 @@ class FTICRResult(object):
             self.tbl = tbl.drop_duplicates(subset=CHEMICAL_ELEMENTS+['Na','C13'])
             self._assigned_tbl = self._filter(tbl, dtype=dtype)
 
+            # peaks sharing a composition are one compound: the first peak of
+            # each composition gives its cpd id and _cpd_index maps every
+            # assigned peak to its compound
+            self._cpd_rows, self._cpd_index = \
+                self._factorize(self._assigned_tbl[CHEMICAL_ELEMENTS].values)
+
             # mapping table: cpd id and molecular formula (unique)
             self.id2mf = self._assigned_tbl.mf.to_dict()
-            self.mf2id = pd.Series(self._assigned_tbl.index.values, index=self._assigned_tbl.mf.values).to_dict()
+            self.mf2id = pd.Series(self._assigned_tbl.index.values,
+                                   index=self._assigned_tbl.mf.values).to_dict()
             
             self._num_peaks = tbl.shape[0]
-            self._num_cpds = self._assigned_tbl.shape[0]
+            self._num_cpds = self._cpd_rows.size
         else:
             print('[Error] Input table requires these columns (output format in Formularity)\n{}'
                 .format(REQUIRED_COLUMNS))
             raise(Exception('Input table format'))
         
+    @classmethod
+    def from_attribute_mapping(cls, data, chunk_size=INSTANCE_CHUNK_SIZE, **kwargs):
+        '''build from the data of a KBaseExperiments.AttributeMapping object.
+            The CHNOPS/C13/Na attributes are converted straight into float64
+            arrays, chunk_size instances at a time, and every other
+            attribute is kept unconverted as an object column, in attribute
+            order. Only the temporary lists of the conversion are bounded by
+            chunk_size: the object and the full table are both held until
+            the object is dropped by the caller.
+        '''
+        attributes = [info['attribute'] for info in data['attributes']]
+        missing = [c for c in REQUIRED_COLUMNS if c not in attributes]
+        if missing:
+            print('[Error] Input table requires these columns (output format in Formularity)\n{}'
+                  .format(REQUIRED_COLUMNS))
+            raise Exception('Input table format')
+        numeric_pos = [i for i, c in enumerate(attributes) if c in NUMERIC_ATTRIBUTES]
+        other_pos = [i for i, c in enumerate(attributes) if c not in NUMERIC_ATTRIBUTES]
+
+        instances = data['instances']
+        num_instances = len(instances)
+        ids = np.empty(num_instances, dtype=object)
+        numeric = np.empty((num_instances, len(numeric_pos)))
+        others = np.empty((num_instances, len(other_pos)), dtype=object)
+
+        items = iter(instances.items())
+        for start in range(0, num_instances, chunk_size):
+            chunk = list(itertools.islice(items, chunk_size))
+            stop = start+len(chunk)
+            ids[start:stop] = [k for k, _ in chunk]
+            values = np.empty((len(chunk), len(attributes)), dtype=object)
+            values[:] = [v for _, v in chunk]
+            numeric[start:stop] = values[:, numeric_pos].astype(np.float64)
+            others[start:stop] = values[:, other_pos]
+
+        # the columns in the order of the attributes
+        columns = {}
+        for i, c in enumerate(attributes):
+            if i in numeric_pos:
+                columns[c] = numeric[:, numeric_pos.index(i)]
+            else:
+                columns[c] = others[:, other_pos.index(i)]
+        return cls(pd.DataFrame(columns, index=ids), **kwargs)
+
+    @classmethod
+    def from_compositions(cls, comp_df, model_params=None):
+        '''results for an arbitrary composition table, e.g. the fractional
+            bin-averaged compositions, computed right away under model_params
+            (see run). Only the CHNOPS columns are used: there is no
+            Formularity validation, C13/Na filtering or deduplication, and
+            rows without any element (or with NaN) are dropped.
+        '''
+        fticr = cls.__new__(cls)
+        tbl = comp_df.copy()
+        tbl[CHEMICAL_ELEMENTS] = tbl[CHEMICAL_ELEMENTS].astype(np.float64)
+        tbl['mf'] = cls.assign_formulas(tbl)
+        tbl.index = 'xcpd__' + pd.RangeIndex(tbl.shape[0]).astype(str)
+        tbl.index.name = 'cpd_id'
+        fticr.tbl = comp_df
+        fticr._assigned_tbl = tbl[(tbl[CHEMICAL_ELEMENTS].sum(axis=1) > 0).values]
+
+        num_cpds = fticr._assigned_tbl.shape[0]
+        fticr._cpd_rows = np.arange(num_cpds)
+        fticr._cpd_index = np.arange(num_cpds)
+        fticr.id2mf = fticr._assigned_tbl.mf.to_dict()
+        fticr.mf2id = pd.Series(fticr._assigned_tbl.index.values,
+                                index=fticr._assigned_tbl.mf.values).to_dict()
+        fticr._num_peaks = comp_df.shape[0]
+        fticr._num_cpds = num_cpds
+
+        chemical_composition = fticr._assigned_tbl[CHEMICAL_ELEMENTS].values
+        fticr.model_params = BatchThermoStoichiometry(chemical_composition,
+                                                      **(model_params or {})).model_params()
+        fticr.cache_hits = 0
+        fticr.cache_misses = num_cpds
+        fticr._set_results(compute_thermo_stoich_tables(
+            chemical_composition, index=fticr._assigned_tbl.mf.values,
+            model_params=fticr.model_params))
+        return fticr
+
     @property
     def num_peaks(self):
         return self._num_peaks
@@ -44,6 +165,19 @@ class FTICRResult(object):
     def num_cpds(self):
         return self._num_cpds
 
+    @staticmethod
+    def _factorize(chemical_composition):
+        '''unique rows of a composition matrix in the order they first appear.
+            Returns the position of the first row of each unique composition
+            and, for every row, the index of its unique composition.
+        '''
+        _, first, inverse = np.unique(chemical_composition, axis=0,
+                                      return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        return first[order], rank[inverse.ravel()]
+
     def isvalid(self, tbl):
         '''
             validate if the input table contains the essential columns, 
@@ -52,22 +186,29 @@ class FTICRResult(object):
         isvalid = np.sum([c not in tbl.columns for c in REQUIRED_COLUMNS])==0
         return isvalid
 
+    @staticmethod
+    def assign_formulas(comp_df):
+        '''build the molecular formulas column by column in CHNOPS order,
+            omitting the elements with zero count and the count of 1
+        '''
+        mf = pd.Series('', index=comp_df.index)
+        for ele in CHEMICAL_ELEMENTS:
+            if ele not in comp_df.columns:
+                continue
+            counts = comp_df[ele]
+            term = (ele + counts.astype(str)).where(counts != 1, ele)
+            mf += term.where(counts > 0, '')
+        return mf
+
     def _filter(self, tbl, dtype=np.int):
         '''filter out unassigned peaks and assign formulas
             TODO: how to deal with C13 and Na
             TODO: how to deal with the duplicated mf
         '''
         # assign formulas
-        def assign_formula(row):
-            mf = ''
-            for ele in CHEMICAL_ELEMENTS:
-                if (ele in row)&(row[ele]>0):
-                    if row[ele]==1: mf += ele
-                    else: mf += ele+str(row[ele])
-            return mf
         tbl[CHEMICAL_ELEMENTS] = tbl[CHEMICAL_ELEMENTS].astype(dtype)
-        tbl['mf'] = tbl.apply(assign_formula, axis=1)
-        tbl['cpd_id'] = ['xcpd__{}'.format(i) for i in range(tbl.shape[0])]
+        tbl['mf'] = self.assign_formulas(tbl)
+        tbl['cpd_id'] = 'xcpd__' + pd.RangeIndex(tbl.shape[0]).astype(str)
         tbl = tbl.set_index('cpd_id')
         
         # filter out unassigned peaks
@@ -83,50 +224,177 @@ class FTICRResult(object):
     def to_csv(self, fout):
         self._assigned_tbl.to_csv(fout)
 
-    def _batch_stoichiometries(self):
-        '''extract all stoichiometries
+    def _batch_stoichiometries(self, cpd_tbl, cache=None, workers=None, model_params=None):
+        '''extract all stoichiometries in a single vectorized pass. If a
+            ThermoStoichCache is given, only the compositions missing from it
+            are computed and then added to it.
+        '''
+        chemical_composition = cpd_tbl[CHEMICAL_ELEMENTS].values.astype(np.float64)
+        params = BatchThermoStoichiometry(chemical_composition,
+                                          **(model_params or {})).model_params()
+        self.model_params = params
+        if cache is None:
+            self.cache_hits = 0
+            self.cache_misses = cpd_tbl.shape[0]
+            return compute_thermo_stoich_tables(chemical_composition, index=cpd_tbl.mf.values,
+                                                workers=workers, model_params=params)
+
+        results = ThermoStoichTables(cpd_tbl.mf.values)
+        values, found = cache.lookup(params, chemical_composition)
+        if found.size > 0:
+            results.set_values(found, values)
+        missing = np.setdiff1d(np.arange(results.num_cpds), found)
+
+        self.cache_hits = found.size
+        self.cache_misses = missing.size
+        if missing.size > 0:
+            computed = compute_thermo_stoich_tables(chemical_composition[missing], workers=workers,
+                                                    model_params=params)
+            values = computed.get_values()
+            results.set_values(missing, values)
+            cache.store(params, chemical_composition[missing], values)
+        return results
+
+    def run(self, cache=None, workers=None, model_params=None):
+        '''compute the stoichiometries and thermodynamic properties.
+            workers > 1 splits the compositions into contiguous shards
+            computed by a process pool. model_params sets the conditions
+            (T, pH, eta, delGsyn) and biomass formula (chemFormBiom), see
+            BatchThermoStoichiometry.
+        '''
+        # compute once per unique composition
+        cpd_tbl = self._assigned_tbl.iloc[self._cpd_rows]
+        self._set_results(self._batch_stoichiometries(cpd_tbl, cache=cache, workers=workers,
+                                                      model_params=model_params))
+
+    @classmethod
+    def run_samples(cls, fticrs, cache=None, workers=None, model_params=None):
+        '''run() for many samples at once: the union of their compositions
+            is computed in a single pass (see run for the arguments) and each
+            sample takes the rows of its own compounds. Returns the number of
+            compounds in the union and the cache hits and misses of the pass.
         '''
-        def get_stoichiometry(row):
-            chem_comp = {e:row[e] for e in CHEMICAL_ELEMENTS}
-            thermo_stoich = ThermoStoichiometry(chem_comp)
-            thermo_stoich.get_all_thermo_stoich()
-            return thermo_stoich
-        return self._assigned_tbl.apply(get_stoichiometry, axis=1).to_dict()
+        cpd_tbls = [fticr._assigned_tbl.iloc[fticr._cpd_rows] for fticr in fticrs]
+        all_cpds = pd.concat(cpd_tbls)
+        union_rows, union_index = cls._factorize(all_cpds[CHEMICAL_ELEMENTS].values)
+
+        union = cls.__new__(cls)
+        results = union._batch_stoichiometries(all_cpds.iloc[union_rows], cache=cache,
+                                               workers=workers, model_params=model_params)
+        offsets = np.cumsum([0]+[tbl.shape[0] for tbl in cpd_tbls])
+        for fticr, start, stop in zip(fticrs, offsets[:-1], offsets[1:]):
+            fticr.model_params = union.model_params
+            # the cache was queried for the union, not for each sample
+            fticr.cache_hits = None
+            fticr.cache_misses = None
+            fticr._set_results(results.take(union_index[start:stop]))
+        return union_rows.size, union.cache_hits, union.cache_misses
+
+    def _set_results(self, results):
+        self.results = results
+        self._lambda_bin_index = None
+        self._stoich_basis = None
 
-    def run(self):
-        self.all_stoich = self._batch_stoichiometries()
         # "stoichD","stoichA","stoichCat","stoichAn_O2","stoichAn_HCO3","stoichMet_O2","stoichMet_HCO3"
-        stoich_colnames = ["donor","h2o","hco3","nh4","hpo4","hs","h","e","acceptor","biom"]
-        self.stoichD = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_electron_donor for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichA = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_electron_acceptor for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichCat = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_cat_rxns for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichAn_O2 = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_anabolic_O2 for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichAn_HCO3 = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_anabolic_HCO3 for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichMet_O2 = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_metabolic_O2 for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
-        self.stoichMet_HCO3 = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].stoich_metabolic_HCO3 for cpd in self.all_stoich},
-            orient='index', columns=stoich_colnames)
+        for name in STOICH_NAMES:
+            setattr(self, name, self.results.frame(name))
+        self.thermo = self.results.frame('thermo')
         
-        thermo_colnames = ["delGcox0PerC","delGcox0","delGcox","delGcat0","delGcat","delGan0_O2","delGan0_HCO3",
-                "delGan_O2","delGan_HCO3","delGdis_O2","delGdis_HCO3","lambda_O2","lambda_HCO3"]
-        self.thermo = pd.DataFrame.from_dict({self.id2mf[cpd]:self.all_stoich[cpd].delta_gibbs_energy+self.all_stoich[cpd].th_lambda for cpd in self.all_stoich},
-            orient='index', columns=thermo_colnames)
-        
-    def save_result_files(self, folder):
-        # save to csv files
-        # self.stoichD.to_csv(folder+'/stoichD.csv')
-        # self.stoichA.to_csv(folder+'/stoichA.csv')
-        # self.stoichCat.to_csv(folder+'/stoichCat.csv')
-        # self.stoichAn_O2.to_csv(folder+'/stoichAn_O2.csv')
-        # self.stoichAn_HCO3.to_csv(folder+'/stoichAn_HCO3.csv')
-        self.stoichMet_O2.to_csv(folder+'/stoichMet_O2.csv')
-        # self.stoichMet_HCO3.to_csv(folder+'/stoichMet_HCO3.csv')
-        self.thermo.to_csv(folder+'/thermodynamic_props.csv')
+    def peak_thermo(self):
+        '''thermodynamic properties scattered back to every assigned peak
+        '''
+        return pd.DataFrame(self.results.thermo[self._cpd_index],
+                            index=self._assigned_tbl.index, columns=THERMO_COLNAMES)
+
+    @property
+    def stoich_basis(self):
+        '''the condition independent ThermoStoichBasis of the results'''
+        if self._stoich_basis is None:
+            self._stoich_basis = ThermoStoichBasis.from_tables(self.results)
+        return self._stoich_basis
+
+    def _conditions(self, T=None, pH=None, eta=None, delGsyn=None):
+        '''the conditions of run with the given ones replaced'''
+        conditions = [self.model_params[name] for name in BatchThermoStoichiometry.CONDITIONS]
+        return [c if value is None else value
+                for c, value in zip(conditions, [T, pH, eta, delGsyn])]
+
+    def set_conditions(self, T=None, pH=None, eta=None, delGsyn=None):
+        '''recompute lambda, the delta Gs and the metabolic stoichiometries
+            in place under new conditions (None keeps the current value).
+            Only the energetics are evaluated, on top of stoich_basis.
+        '''
+        conditions = self._conditions(T, pH, eta, delGsyn)
+        th_lambda, delta_gibbs_energy, stoichMet_O2, stoichMet_HCO3 = \
+            self.stoich_basis.energetics(
+                *BatchThermoStoichiometry.broadcast_conditions(*conditions))
+        if th_lambda.ndim != 2:
+            raise ValueError('set_conditions takes a single set of conditions, see scenario_thermo')
+
+        n_delG = delta_gibbs_energy.shape[1]
+        self.results.thermo[:, :n_delG] = delta_gibbs_energy
+        self.results.thermo[:, n_delG:] = th_lambda
+        self.results.stoich[STOICH_NAMES.index('stoichMet_O2')] = stoichMet_O2
+        self.results.stoich[STOICH_NAMES.index('stoichMet_HCO3')] = stoichMet_HCO3
+        self.model_params = dict(self.model_params,
+                                 **{name: float(c) for name, c in
+                                    zip(BatchThermoStoichiometry.CONDITIONS, conditions)})
+        # summaries of the old values, streamed again on demand
+        self.results.summaries = {}
+        self._lambda_bin_index = None
+
+    def scenario_thermo(self, T=None, pH=None, eta=None, delGsyn=None):
+        '''thermodynamic properties of every compound under K conditions
+            (scalars or arrays broadcast against each other, None keeps the
+            value of run). Only the energetics are evaluated, on top of
+            stoich_basis, in one vectorized pass. Returns a long table with
+            one row per condition and compound.
+        '''
+        conditions = np.broadcast_arrays(*[np.atleast_1d(np.asarray(c, dtype=np.float64))
+                                           for c in self._conditions(T, pH, eta, delGsyn)])
+        th_lambda, delta_gibbs_energy, _, _ = self.stoich_basis.energetics(
+            *BatchThermoStoichiometry.broadcast_conditions(*conditions))
+
+        num_conditions, num_cpds = th_lambda.shape[:2]
+        scenario_df = pd.DataFrame(np.concatenate([delta_gibbs_energy, th_lambda], axis=-1)
+                                   .reshape(num_conditions*num_cpds, -1), columns=THERMO_COLNAMES)
+        for i, name in enumerate(BatchThermoStoichiometry.CONDITIONS):
+            scenario_df.insert(i, name, np.repeat(conditions[i], num_cpds))
+        scenario_df.insert(len(conditions), 'mf',
+                           np.tile(self.results.index.values, num_conditions))
+        return scenario_df
+
+    def stoich_matrices(self):
+        '''all seven stoichiometry matrices stacked in one long table with
+            the matrix name in the "matrix" column
+        '''
+        num_cpds = self.results.num_cpds
+        stoich_df = pd.DataFrame(self.results.stoich.reshape(-1, len(STOICH_COLNAMES)),
+                                 columns=STOICH_COLNAMES)
+        stoich_df.insert(0, 'matrix', pd.Categorical.from_codes(
+            np.repeat(np.arange(len(STOICH_NAMES)), num_cpds), categories=STOICH_NAMES))
+        stoich_df.insert(1, 'mf', np.tile(self.results.index.values, len(STOICH_NAMES)))
+        return stoich_df
+
+    def save_result_files(self, folder, fmt='csv', tables=RESULT_TABLES):
+        '''save the result tables in the given format (csv, parquet or
+            feather). tables can name any of STOICH_NAMES, "thermodynamic_props"
+            and "stoich_matrices" (all stoichiometries in one file).
+            Returns the paths written by table name.
+        '''
+        paths = {}
+        for name in tables:
+            if name == 'thermodynamic_props':
+                df = self.thermo
+            elif name == 'stoich_matrices':
+                df = self.stoich_matrices()
+            elif name in STOICH_NAMES:
+                df = getattr(self, name)
+            else:
+                raise ValueError('Unknown result table: {}'.format(name))
+            index = name != 'stoich_matrices'
+            paths[name] = write_table(df, os.path.join(folder, name), fmt=fmt, index=index)
+        return paths
     
     def create_fba_model_files(self, folder, prefix='temp'):
         compounds_file = os.path.join(folder, "{}_comps.tsv".format(prefix))
@@ -141,51 +409,58 @@ class FTICRResult(object):
 
     def create_cpd_file_fba_model(self, fout):
         comp_cols = ['id','name','formula','charge','inchikey','smiles','deltag','kegg id','ms id']
-        compounds = [{'id':'{}_c0'.format(cid),'formula':self.id2mf[cid]} for cid in self.id2mf]
-        compounds.append({'id':'h2o_c0','formula':'H2O'})
-        compounds.append({'id':'hco3_c0','formula':'HCO3'})
-        compounds.append({'id':'nh4_c0','formula':'NH4'})
-        compounds.append({'id':'hpo4_c0','formula':'HPO4'})
-        compounds.append({'id':'hs_c0','formula':'HS'})
-        compounds.append({'id':'h_c0','formula':'H'})
-        compounds.append({'id':'e_c0','formula':'e-'})
-        compounds.append({'id':'acceptor_c0','formula':'O2'})
-        compounds.append({'id':'biom_c0','formula':'CH1.8N0.2O0.5'})
-        comp_df = pd.DataFrame(compounds, columns=comp_cols)
-        comp_df.to_csv(fout, sep='\t', index=False)
+        extra_compounds = [('h2o_c0', 'H2O'), ('hco3_c0', 'HCO3'), ('nh4_c0', 'NH4'),
+                           ('hpo4_c0', 'HPO4'), ('hs_c0', 'HS'), ('h_c0', 'H'), ('e_c0', 'e-'),
+                           ('acceptor_c0', 'O2'), ('biom_c0', 'CH1.8N0.2O0.5')]
+
+        def rows():
+            blank = [''] * (len(comp_cols) - 3)
+            for cid, mf in self.id2mf.items():
+                yield ['{}_c0'.format(cid), '', mf] + blank
+            for cid, mf in extra_compounds:
+                yield [cid, '', mf] + blank
+        write_tsv(fout, comp_cols, rows())
 
     def create_rxn_file_fba_model(self, stoich_mat, fout):
         rxn_cols = ['id','direction','compartment','gpr','name','enzyme','deltag','reference','equation',
             'definition','ms id','bigg id','kegg id','kegg pathways','metacyc pathways']
-        
-        stoich_colnames = ["donor","h2o","hco3","nh4","hpo4","hs","h","e","acceptor","biom"]
-
-        def generate_equation(r):
-            reactants = []
-            products = []
-            for col in stoich_colnames:
-                if col=='donor': name = self.mf2id[r.name]
-                else: name = col
-
-                if r[col] == 0: continue
-                elif r[col] > 0:
-                    products.append('({0})  {1}[c0]'.format(r[col], name))
-                else:
-                    reactants.append('({0})  {1}[c0]'.format(-r[col], name))
-            return '{} <=> {}'.format(' + '.join(reactants), ' + '.join(products))
-        
-        reactions = []
-        for i, eq in enumerate(stoich_mat.apply(generate_equation, axis=1).tolist()):
-            reactions.append({'id':'xrxn{}_c0'.format(i+1),'equation':eq})
-        
-        rxn_df = pd.DataFrame(reactions,columns=rxn_cols)
-        rxn_df.to_csv(fout, sep='\t', index=False)
+        eq_col = rxn_cols.index('equation')
+
+        # build both sides of every equation column by column: a species is a
+        # product where its coefficient is positive and a reactant where it is
+        # negative (or nan), zero coefficients are left out
+        num_rxns = stoich_mat.shape[0]
+        reactants = np.full(num_rxns, '', dtype=object)
+        products = np.full(num_rxns, '', dtype=object)
+        for col in STOICH_COLNAMES:
+            if col == 'donor':
+                name = np.array([self.mf2id[mf] for mf in stoich_mat.index], dtype=object)
+            else:
+                name = col
+            coef = stoich_mat[col].to_numpy(dtype=np.float64)
+            is_product = coef > 0
+            is_reactant = ~is_product & (coef != 0)
+            # repr of a python float is the same text str gives a numpy float64
+            coef_str = np.array(list(map(repr, np.where(is_product, coef, -coef).tolist())),
+                                dtype=object)
+            term = '(' + coef_str + ')  ' + name + '[c0]'
+            for side, mask in ((products, is_product), (reactants, is_reactant)):
+                side[mask] = np.where(side[mask] == '', term[mask], side[mask] + ' + ' + term[mask])
+        equations = reactants + ' <=> ' + products
+
+        def rows():
+            empty = [''] * len(rxn_cols)
+            for i, eq in enumerate(equations):
+                row = list(empty)
+                row[0] = 'xrxn{}_c0'.format(i+1)
+                row[eq_col] = eq
+                yield row
+        write_tsv(fout, rxn_cols, rows())
 
     def create_media_file(self, media_file):
         media_cols = ['compounds','name','formula','minFlux','maxFlux','concentration']
-        media_compounds = [{'compounds':_id,'formula':self.id2mf[_id],'name':self.id2mf[_id],'minFlux':-1000,'maxFlux':1000,'concentration':1} for _id in self.id2mf]
-        media_df = pd.DataFrame(media_compounds, columns=media_cols)
-        media_df.to_csv(media_file, sep='\t', index=False)
+        rows = ((_id, mf, mf, -1000, 1000, 1) for _id, mf in self.id2mf.items())
+        write_tsv(media_file, media_cols, rows)
 
     def plot_lambda_dist(self, fout='lambda_dist.png'):
         if self.thermo is not None:
@@ -213,8 +488,25 @@ class FTICRResult(object):
         else:
             print('[Warning] "plot_lambda_dist" requires self.thermo. Please use run().')
 
-    def get_summary(self, colname):
+    def _streaming_summary(self, colname):
+        '''the StreamingSummary of a column, streamed over the column on
+            first use and kept with the results
+        '''
+        if colname not in self.results.summaries:
+            self.results.summaries.update(self.results.summarize([colname]))
+        return self.results.summaries[colname]
+
+    def get_summary(self, colname, exact=True):
+        '''mean, standard deviation and median of a column of the compounds'
+            thermodynamic properties, computed from the full column. With
+            exact=False they come from the mergeable StreamingSummary instead
+            (finite values, approximate median).
+        '''
         if self.thermo is not None:
+            if not exact:
+                summary = self._streaming_summary(colname)
+                return (summary.mean if summary.count else np.nan, summary.std(ddof=1),
+                        summary.median())
             return (self.thermo[colname].mean(),
                     self.thermo[colname].std(ddof=1),
                     self.thermo[colname].median())
@@ -222,58 +514,136 @@ class FTICRResult(object):
             print('[Warning] "plot_lambda_dist" requires self.thermo. Please use run().')
             return (np.nan, np.nan, np.nan)
 
-    def plot_van_krevelen(self, fout):
-        df = self._assigned_tbl.copy()
-        plt.figure(figsize=(10,8))
-        df["H:C"] = df.H / df.C
-        df["O:C"] = df.O / df.C
+    def get_quantiles(self, colname, q, exact=True):
+        '''quantiles q (0 to 1) of a column, approximate with exact=False'''
+        if exact:
+            quantiles = self.thermo[colname].quantile(q)
+            return quantiles.values if np.ndim(q) else quantiles
+        return self._streaming_summary(colname).quantile(q)
 
-        g = sns.scatterplot("O:C", "H:C", hue="Class", alpha=1, s=15, data=df)
+    def distribution_sketches(self, columns=SKETCH_COLUMNS):
+        '''mergeable fixed-edge DistributionSketch of each column of the
+            compounds' thermodynamic properties (see DistributionSketch)
+        '''
+        return {column: DistributionSketch.from_values(self.thermo[column].values,
+                                                       SKETCH_EDGES[column])
+                for column in columns}
+
+    @staticmethod
+    def _stratified_sample(labels, max_points, seed=0):
+        '''positions (in order) of at most about max_points rows, drawn from
+            each label in proportion to its size but at least one per label
+        '''
+        num_rows = len(labels)
+        if max_points <= 0 or num_rows <= max_points:
+            return np.arange(num_rows)
+        # missing labels (-1) are a group of their own
+        codes = pd.factorize(labels)[0]+1
+        sizes = np.bincount(codes)
+        quotas = np.minimum(sizes, np.maximum(1, sizes*max_points//num_rows))
+        # a random rank within each label
+        order = np.lexsort((np.random.default_rng(seed).random(num_rows), codes))
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        rank = np.arange(num_rows)-starts[codes[order]]
+        return np.sort(order[rank < quotas[codes[order]]])
+
+    @staticmethod
+    def _axis_limits(values, margin=0.05):
+        '''the autoscaled limits of matplotlib (5% margins) for all values,
+            or None (the default limits) when none of them is finite
+        '''
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return None
+        lo, hi = values.min(), values.max()
+        pad = (hi-lo)*margin if hi > lo else 0.5
+        return lo-pad, hi+pad
+
+    def plot_van_krevelen(self, fout, max_points=MAX_VAN_KREVELEN_POINTS, figsize=(10, 8),
+                          legend_fontsize=15):
+        '''van Krevelen diagram of the compounds colored by Class. At most
+            about max_points compounds are drawn (stratified by Class, so the
+            rendering time does not grow with the data) while the axis limits
+            and the legend cover all of them. Returns the axes.
+        '''
+        df = self._assigned_tbl.iloc[self._cpd_rows]
+        ratios = pd.DataFrame({"O:C": (df.O / df.C).values, "H:C": (df.H / df.C).values,
+                               "Class": df.Class.values})
+        drawn = ratios.iloc[self._stratified_sample(ratios.Class.values, max_points)]
+
+        plt.figure(figsize=figsize)
+        g = sns.scatterplot(x="O:C", y="H:C", hue="Class", hue_order=ratios.Class.dropna().unique(),
+                            alpha=1, s=15, data=drawn)
+        g.set_xlim(self._axis_limits(ratios["O:C"].values))
+        g.set_ylim(self._axis_limits(ratios["H:C"].values))
         g.set_xlabel("O:C", fontsize=15)
         g.set_ylabel("H:C", fontsize=15)
-        plt.legend(bbox_to_anchor=(1.04,1), loc="upper left", fontsize=15)
+        plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left", fontsize=legend_fontsize)
         plt.tight_layout()
-        
+
         plt.savefig(fout)
-        
-    def average_by_lambda_bins_uniform(self, n_bins=10, cutoff=5):
-        '''
-        average compositions per each bin (uniform interval in each lambda bin)
-        in the lambda distribution after filtering out the two-side tails by
-        a cutoff percent (%)
+        return g
+
+    @property
+    def lambda_bin_index(self):
+        '''LambdaBinIndex of the current results, built on first use after run()
         '''
+        if self._lambda_bin_index is None:
+            self._lambda_bin_index = LambdaBinIndex(
+                self.thermo.lambda_O2.values, self._cpd_index,
+                self._assigned_tbl[REQUIRED_COLUMNS].values)
+        return self._lambda_bin_index
+
+    def _uniform_lambda_bins(self, n_bins, cutoff):
         assert 0 <= cutoff < 100, "cutoff must be 0 <= cutoff < 100"
         assert 0 < n_bins, "n_bins must be 0 < n_bins"
+        return self.lambda_bin_index.uniform_bins(n_bins, cutoff)
 
-        # data
-        lambda_dist = self.thermo.lambda_O2.values
-        comp_df = self._assigned_tbl[REQUIRED_COLUMNS].copy()
-        # th_lambda[0] --> lambda_O2
-        comp_df['lambda'] = comp_df.apply(lambda x: self.all_stoich[x.name].th_lambda[0], axis=1)
-
-        # get the boundary
-        if cutoff > 0:
-            lambda_min = np.percentile(lambda_dist, cutoff)
-            lambda_max = np.percentile(lambda_dist, 100-cutoff)
-        elif cutoff == 0:
-            lambda_min = 0
-            lambda_max = np.amax(lambda_dist)
-        print('lambda_min', lambda_min, 'lambda_max', lambda_max)
-
-        # get the bins
-        bins = np.linspace(lambda_min, lambda_max, n_bins+1)
-        print("bins:", bins)
+    def _cumulative_lambda_bins(self, n_bins, cutoff):
+        assert 0 <= cutoff < 100, "cutoff must be 0 <= cutoff < 100"
+        assert 0 < n_bins, "n_bins must be 0 < n_bins"
+        assert n_bins < self.num_cpds, "n_bins must be n_bins < number of compounds"
+        return self.lambda_bin_index.cumulative_bins(n_bins, cutoff)
 
-        # binning
+    def _average_by_bins(self, bins):
+        '''average compositions (and lambda) of the assigned peaks falling in
+            each right-closed lambda interval (bins[i], bins[i+1]], like pd.cut
+        '''
+        n_bins = len(bins)-1
         labels = ['Bin{}'.format(i+1) for i in range(n_bins)]
-        comp_df['Class'] = pd.cut(comp_df['lambda'], bins=bins, labels=labels)
-        tdf = comp_df[comp_df['Class'].notnull()]
-
-        new_comp = tdf.groupby('Class').mean()
+        new_comp = pd.DataFrame(self.lambda_bin_index.average(bins),
+                                columns=REQUIRED_COLUMNS+['lambda'])
+        new_comp.insert(0, 'Class', pd.Categorical(labels, categories=labels))
         new_comp['Na'] = 0
         new_comp['C13'] = 0
+        return new_comp
 
-        return new_comp.reset_index()
+    def average_by_lambda_bin_specs(self, specs):
+        '''average compositions for many binnings of the same lambda
+            distribution. specs is a list of (n_bins, cutoff, bin_method)
+            with bin_method "cumulative" or "uniform"; the sorted lambda index
+            is shared, so each spec costs O(n_bins log N).
+        '''
+        new_comps = []
+        for n_bins, cutoff, bin_method in specs:
+            if bin_method == 'cumulative':
+                bins = self._cumulative_lambda_bins(n_bins, cutoff)
+            elif bin_method == 'uniform':
+                bins = self._uniform_lambda_bins(n_bins, cutoff)
+            else:
+                raise ValueError('bin_method must be "cumulative" or "uniform": {}'
+                                 .format(bin_method))
+            new_comps.append(self._average_by_bins(bins))
+        return new_comps
+
+    def average_by_lambda_bins_uniform(self, n_bins=10, cutoff=5):
+        '''
+        average compositions per each bin (uniform interval in each lambda bin)
+        in the lambda distribution after filtering out the two-side tails by
+        a cutoff percent (%)
+        '''
+        bins = self._uniform_lambda_bins(n_bins, cutoff)
+        return self._average_by_bins(bins)
 
     def average_by_lambda_bins(self, n_bins=10, cutoff=5):
         '''
@@ -282,45 +652,235 @@ class FTICRResult(object):
         split in a cummulative fashion, indicating each bin has the same area
         in the lambda distribution.
         '''
-        assert 0 <= cutoff < 100, "cutoff must be 0 <= cutoff < 100"
-        assert 0 < n_bins, "n_bins must be 0 < n_bins"
+        bins = self._cumulative_lambda_bins(n_bins, cutoff)
+        return self._average_by_bins(bins)
+
+
+class LambdaBinIndex(object):
+    """lambda distribution sorted once for repeated binning
+
+    Keeps the sorted lambda of the compounds (for the bin edges) and of the
+    assigned peaks, together with the prefix sums of the peak compositions
+    and lambda in that order, so the averages over any set of bins need only
+    a binary search per edge.
+
+    As in the formula keyed thermo table, the edges are percentiles over the
+    unique compositions while the counts and averages cover every assigned
+    peak, duplicates included. A peak whose lambda equals an edge up to the
+    last digit may fall in either neighbouring bin, depending on rounding.
+    """
+    def __init__(self, cpd_lambda, cpd_index, peak_comp):
+        super(LambdaBinIndex, self).__init__()
+        self.cpd_lambda = np.sort(cpd_lambda)
+
+        peak_lambda = cpd_lambda[cpd_index]
+        order = np.argsort(peak_lambda, kind='stable')
+        self.peak_lambda = peak_lambda[order]
+        values = np.column_stack([np.asarray(peak_comp, dtype=np.float64)[order], self.peak_lambda])
+        self.prefix = np.zeros((values.shape[0]+1, values.shape[1]))
+        np.cumsum(values, axis=0, out=self.prefix[1:])
+
+    def max(self):
+        return self.cpd_lambda[-1]
+
+    def uniform_bins(self, n_bins, cutoff):
+        '''n_bins equal intervals between the cutoff and 100-cutoff
+            percentiles, or between 0 and the largest lambda without a cutoff
+        '''
+        return lambda_bin_edges(self.cpd_lambda, n_bins, cutoff, 'uniform')
+
+    def cumulative_bins(self, n_bins, cutoff):
+        '''n_bins intervals holding the same share of the compounds between
+            the cutoff and 100-cutoff percentiles (from 0 without a cutoff)
+        '''
+        return lambda_bin_edges(self.cpd_lambda, n_bins, cutoff, 'cumulative')
 
-        num_compounds = self.thermo.shape[0]
+    def bins(self, n_bins, cutoff, bin_method):
+        '''bin edges of bin_method "cumulative" or "uniform"'''
+        return lambda_bin_edges(self.cpd_lambda, n_bins, cutoff, bin_method)
 
-        assert n_bins < num_compounds, "n_bins must be n_bins < number of compounds"
-        
-        # data
-        lambda_dist = self.thermo.lambda_O2.values
-        comp_df = self._assigned_tbl[REQUIRED_COLUMNS].copy()
-        # th_lambda[0] --> lambda_O2
-        comp_df['lambda'] = comp_df.apply(lambda x: self.all_stoich[x.name].th_lambda[0], axis=1)
-
-        # get the bins
-        bins = []
+    def percentile(self, q):
+        '''np.percentile (linear) of the compound lambda from the sorted values
+        '''
+        return sorted_percentile(self.cpd_lambda, q)
+
+    def counts(self, bins):
+        '''number of peaks in each right-closed interval (bins[i], bins[i+1]]'''
+        return np.diff(np.searchsorted(self.peak_lambda, bins, side='right'))
+
+    def average(self, bins):
+        '''(n_bins, 7) mean compositions and lambda of the peaks in each
+            right-closed interval (bins[i], bins[i+1]]; NaN for empty bins
+        '''
+        bins = np.asarray(bins, dtype=np.float64)
+        if np.any(np.diff(bins) < 0):
+            raise ValueError('bins must increase monotonically: {}'.format(bins))
+        # number of peaks with lambda <= each edge
+        positions = np.searchsorted(self.peak_lambda, bins, side='right')
+        counts = np.diff(positions)
+        sums = np.diff(self.prefix[positions], axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums/counts[:, None]
+
+
+def sorted_percentile(sorted_values, q, counts=None):
+    '''np.percentile (linear) of values sorted along the last axis, over the
+        first counts values of each row (all of them by default). Returns
+        shape (..., *q.shape); NaN for the rows whose last value is NaN.
+    '''
+    q = np.asarray(q, dtype=np.float64)
+    lead = sorted_values.shape[:-1]
+    values = sorted_values.reshape(-1, sorted_values.shape[-1])
+    n = sorted_values.shape[-1] if counts is None else counts
+    n = np.broadcast_to(n, lead).reshape(-1, 1)
+    pos = q.reshape(1, -1)/100*(n-1)
+    lo = np.clip(np.floor(pos).astype(np.int64), 0, n-1)
+    hi = np.minimum(lo+1, n-1)
+    t = pos-lo
+    a = np.take_along_axis(values, lo, axis=1)
+    b = np.take_along_axis(values, hi, axis=1)
+    result = np.where(t >= 0.5, b-(b-a)*(1-t), a+(b-a)*t)
+    result[np.isnan(np.take_along_axis(values, n-1, axis=1)[:, 0])] = np.nan
+    return result.reshape(lead+q.shape)
+
+
+def lambda_bin_edges(sorted_lambda, n_bins, cutoff, bin_method, counts=None):
+    '''(..., n_bins+1) bin edges of bin_method "cumulative" or "uniform"
+        (see LambdaBinIndex) from compound lambda sorted along the last
+        axis, over the first counts values of each row (all by default)
+    '''
+    if bin_method == 'cumulative':
+        # all the percentiles at once
         cum_interval = (100-cutoff*2) / n_bins
-        print('cum_interval',cum_interval)
+        percents = np.clip(cutoff+cum_interval*np.arange(n_bins+1), 0, 100)
+        bins = sorted_percentile(sorted_lambda, percents, counts)
         if cutoff == 0:
-            bins = [0]
+            bins[..., 0] = 0
+        return bins
+    elif bin_method == 'uniform':
+        if cutoff > 0:
+            limits = sorted_percentile(sorted_lambda, [cutoff, 100-cutoff], counts)
+            lambda_min, lambda_max = limits[..., 0], limits[..., 1]
         else:
-            bins = [np.percentile(lambda_dist, cutoff)]
-
-        th = cutoff
-        for i in range(n_bins):
-            th += cum_interval
-            bins.append(np.percentile(lambda_dist, th))
-        print("bins:", bins)
-        # binning
-        # bins = np.linspace(lambda_min, lambda_max, n_bins+1)
-        labels = ['Bin{}'.format(i+1) for i in range(n_bins)]
-        comp_df['Class'] = pd.cut(comp_df['lambda'], bins=bins, labels=labels)
-        tdf = comp_df[comp_df['Class'].notnull()]
+            n = sorted_lambda.shape[-1] if counts is None else counts
+            last = np.broadcast_to(np.asarray(n)-1, sorted_lambda.shape[:-1])[..., None]
+            lambda_min = 0
+            lambda_max = np.take_along_axis(sorted_lambda, last, axis=-1)[..., 0]
+        return np.linspace(lambda_min, lambda_max, n_bins+1, axis=-1)
+    raise ValueError('bin_method must be "cumulative" or "uniform": {}'.format(bin_method))
+
+
+def write_table(df, fout, fmt='csv', index=True):
+    '''write a table as csv, parquet or feather to fout (without extension)
+        and return the path written
+    '''
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError('Output format must be one of {}: {}'.format(list(OUTPUT_FORMATS), fmt))
+    path = fout+OUTPUT_FORMATS[fmt]
+    if fmt == 'csv':
+        df.to_csv(path, index=index)
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=index)
+    elif fmt == 'feather':
+        # feather keeps no index, so it is stored as a column
+        df = df.reset_index() if index else df.reset_index(drop=True)
+        df.to_feather(path)
+    return path
+
+
+def write_tsv(fout, columns, rows, buffer_size=1 << 20):
+    '''stream rows (an iterable of sequences) to a tab separated file in
+        the same dialect as DataFrame.to_csv(sep='\\t', index=False)
+    '''
+    with open(fout, 'w', newline='', buffering=buffer_size) as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator=os.linesep)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+class ThermoStoichTables(object):
+    """contiguous storage of the thermo stoichiometry results
+
+    stoich: (7, N, 10) float64 block, one (N, 10) matrix per STOICH_NAMES
+    thermo: (N, 13) float64 block with THERMO_COLNAMES columns
+    The DataFrames returned by frame() are views over these blocks.
+    """
+    def __init__(self, index, stoich=None, thermo=None):
+        '''stoich and thermo can be preallocated blocks (e.g. in shared memory)
+        '''
+        super(ThermoStoichTables, self).__init__()
+        self.index = pd.Index(index)
+        num_cpds = len(self.index)
+        if stoich is None:
+            stoich = np.empty(self.stoich_shape(num_cpds))
+        if thermo is None:
+            thermo = np.empty(self.thermo_shape(num_cpds))
+        self.stoich = stoich
+        self.thermo = thermo
+        # StreamingSummary of thermo columns by name, filled on demand by
+        # FTICRResult.get_summary(exact=False) and get_quantiles
+        self.summaries = {}
+
+    @staticmethod
+    def stoich_shape(num_cpds):
+        return (len(STOICH_NAMES), num_cpds, len(STOICH_COLNAMES))
+
+    @staticmethod
+    def thermo_shape(num_cpds):
+        return (num_cpds, len(THERMO_COLNAMES))
 
-        new_comp = tdf.groupby('Class').mean()
-        new_comp['Na'] = 0
-        new_comp['C13'] = 0
+    @property
+    def num_cpds(self):
+        return len(self.index)
+
+    def fill(self, thermo_stoich, rows=slice(None)):
+        '''copy the results of a BatchThermoStoichiometry into the given rows
+        '''
+        for i, values in enumerate([thermo_stoich.stoich_electron_donor,
+                                    thermo_stoich.stoich_electron_acceptor,
+                                    thermo_stoich.stoich_cat_rxns,
+                                    thermo_stoich.stoich_anabolic_O2,
+                                    thermo_stoich.stoich_anabolic_HCO3,
+                                    thermo_stoich.stoich_metabolic_O2,
+                                    thermo_stoich.stoich_metabolic_HCO3]):
+            self.stoich[i, rows] = values
+        n_delG = thermo_stoich.delta_gibbs_energy.shape[1]
+        self.thermo[rows, :n_delG] = thermo_stoich.delta_gibbs_energy
+        self.thermo[rows, n_delG:] = thermo_stoich.th_lambda
+
+    def get_values(self, rows=slice(None)):
+        '''flat (n, 83) rows laid out as BatchThermoStoichiometry.get_all_thermo_stoich
+        '''
+        return np.hstack([self.thermo[rows]] +
+                         [self.stoich[i, rows] for i in range(len(STOICH_NAMES))])
 
-        return new_comp.reset_index()
+    def set_values(self, rows, values):
+        '''inverse of get_values
+        '''
+        n_thermo = len(THERMO_COLNAMES)
+        n_stoich = len(STOICH_COLNAMES)
+        self.thermo[rows] = values[:, :n_thermo]
+        for i in range(len(STOICH_NAMES)):
+            self.stoich[i, rows] = values[:, n_thermo+i*n_stoich:n_thermo+(i+1)*n_stoich]
+
+    def take(self, rows):
+        '''a copy holding the given rows, in that order'''
+        return ThermoStoichTables(self.index[rows], stoich=self.stoich[:, rows],
+                                  thermo=self.thermo[rows])
+
+    def summarize(self, columns, rows=slice(None)):
+        '''StreamingSummary of the given thermo columns over the given rows,
+            streamed in chunks
+        '''
+        return summarize_columns(self.thermo[rows], {c: THERMO_COLNAMES.index(c) for c in columns})
 
+    def frame(self, name):
+        '''zero-copy DataFrame view of a stoichiometry matrix or of "thermo"
+        '''
+        if name == 'thermo':
+            return pd.DataFrame(self.thermo, index=self.index, columns=THERMO_COLNAMES, copy=False)
+        values = self.stoich[STOICH_NAMES.index(name)]
+        return pd.DataFrame(values, index=self.index, columns=STOICH_COLNAMES, copy=False)
 
 
 class ThermoStoichiometry(object):
@@ -585,3 +1145,447 @@ class ThermoStoichiometry(object):
             list(self.stoich_metabolic_O2) + \
             list(self.stoich_metabolic_HCO3)
 
+
+class BatchThermoStoichiometry(object):
+    """extract thermo stoichiometries for a batch of chemical compositions
+
+    Vectorized counterpart of ThermoStoichiometry: each stoichiometry is an
+    (N, 10) array and each delta G an (N,) array, so all compounds are
+    computed with whole-array operations instead of one object per formula.
+
+    The thermodynamic conditions (T, pH, eta, delGsyn) can also be 1-D arrays
+    of K conditions: the stoichiometries that do not depend on them are
+    computed once and lambda, the delta Gs and the metabolic stoichiometries
+    get a leading condition axis, e.g. (K, N) and (K, N, 10).
+    """
+
+    # model parameters
+    T = 298  # K
+    pH = 7
+    eta = 0.43
+    delGsyn = 200  # kJ/(mol.X)
+    chemFormBiom = (1, 1.8, 0.2, 0.5, 0, 0, 0)  # C H_1.8 N_0.2 O_0.5
+    CONDITIONS = ['T', 'pH', 'eta', 'delGsyn']
+
+    def __init__(self, chemical_composition, T=None, pH=None, eta=None, delGsyn=None,
+                 chemFormBiom=None):
+        """chemical_composition: (N, 6) array of CHNOPS counts
+        T, pH, eta, delGsyn: scalars or 1-D arrays of conditions, broadcast
+            against each other (None keeps the default)
+        chemFormBiom: biomass formula (C, H, N, O, P, S, charge)
+        """
+        super(BatchThermoStoichiometry, self).__init__()
+        self.chemical_composition = np.asarray(chemical_composition, dtype=np.float64)\
+            .reshape(-1, len(CHEMICAL_ELEMENTS))
+        for name, value in zip(self.CONDITIONS, [T, pH, eta, delGsyn]):
+            if value is not None:
+                setattr(self, name, value)
+        if chemFormBiom is not None:
+            self.chemFormBiom = tuple(chemFormBiom)
+
+    @property
+    def num_cpds(self):
+        return self.chemical_composition.shape[0]
+
+    @property
+    def num_conditions(self):
+        '''K for arrays of conditions, None for a single condition'''
+        shape = np.broadcast(*[np.asarray(getattr(self, name)) for name in self.CONDITIONS]).shape
+        return shape[0] if shape else None
+
+    def conditions(self):
+        '''T, pH, eta and delGsyn as floats, or as (K, 1) arrays that
+            broadcast against (N,) per compound values
+        '''
+        return self.broadcast_conditions(*[getattr(self, name) for name in self.CONDITIONS])
+
+    @staticmethod
+    def broadcast_conditions(T, pH, eta, delGsyn):
+        '''see conditions()'''
+        values = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64)
+                                       for v in [T, pH, eta, delGsyn]])
+        if values[0].ndim == 0:
+            return [float(v) for v in values]
+        return [v.reshape(-1, 1) for v in values]
+
+    def model_params(self):
+        '''the parameters that, together with a composition, determine the results
+        '''
+        params = {name: np.asarray(getattr(self, name), dtype=np.float64).tolist()
+                  for name in self.CONDITIONS}
+        params['chemFormBiom'] = [float(x) for x in self.chemFormBiom]
+        return params
+
+    def get_stoich_electron_donor(self):
+        a, b, c, d, e, f = self.chemical_composition.T
+        z = 0
+
+        stoich_electron_donor = np.zeros((self.num_cpds, 10))
+        stoich_electron_donor[:, 0] = -1
+        stoich_electron_donor[:, 1] = -(3*a+4*e-d)
+        stoich_electron_donor[:, 2] = a
+        stoich_electron_donor[:, 3] = c
+        stoich_electron_donor[:, 4] = e
+        stoich_electron_donor[:, 5] = f
+        stoich_electron_donor[:, 6] = 5*a+b-4*c-2*d+7*e-f
+        stoich_electron_donor[:, 7] = -z+4*a+b-3*c-2*d+5*e-2*f
+        return stoich_electron_donor
+
+    def get_stoich_electron_acceptor(self):
+        stoich_electron_acceptor = np.zeros((self.num_cpds, 10))
+        stoich_electron_acceptor[:, 8] = -1  # oxygen
+        stoich_electron_acceptor[:, 6] = -4  # h+
+        stoich_electron_acceptor[:, 7] = -4  # e-
+        stoich_electron_acceptor[:, 1] = 2  # h2o
+        return stoich_electron_acceptor
+
+    def get_stoich_catabolic_reaciton(self, stoich_electron_donor, stoich_electron_acceptor):
+        yEd = stoich_electron_donor[:, 7]
+        yEa = stoich_electron_acceptor[:, 7]
+        return stoich_electron_donor-(yEd/yEa)[:, None]*stoich_electron_acceptor
+
+    def get_stoich_anabolic_reaction(self,
+                                     chemical_composition,
+                                     stoich_electron_donor,
+                                     stoich_electron_acceptor):
+        a = chemical_composition[:, 0]
+
+        aB, bB, cB, dB, eB, fB, zB = self.chemFormBiom
+
+        # biomass half reaction is the same for all compounds
+        stoichAnStarB = -np.array([
+            -1,
+            -(3*aB+4*eB-dB),
+            aB,
+            cB,
+            eB,
+            fB,
+            5*aB+bB-4*cB-2*dB+7*eB-fB,
+            -zB+4*aB+bB-3*cB-2*dB+5*eB-2*fB,
+            0,
+            0
+        ])
+        stoichAnStarB[-1] = stoichAnStarB[0]
+        stoichAnStarB[0] = 0
+
+        yEd = stoich_electron_donor[:, 7]
+        yEa = stoich_electron_acceptor[:, 7]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # electron acceptor for anabolic reaction: O2
+            # Kleerebezem and Van Loosdrecht (2010)
+            stoichAnStar_O2 = stoichAnStarB+stoich_electron_donor/a[:, None]
+            yEana = stoichAnStar_O2[:, 7]
+            coef_acceptor = np.where(yEana > 0, yEana/yEa, 0)
+            coef_donor = np.where(yEana < 0, yEana/yEd, 0)
+            stoichAn_O2 = stoichAnStar_O2 \
+                - coef_acceptor[:, None]*stoich_electron_acceptor \
+                - coef_donor[:, None]*stoich_electron_donor
+
+            # electron acceptor for anabolic reaction: HCO3-
+            # McCarty (year?)
+            stoichAn_HCO3 = stoich_electron_donor-(yEd/stoichAnStarB[7])[:, None]*stoichAnStarB
+            stoichAn_HCO3 = stoichAn_HCO3/stoichAn_HCO3[:, 9:10]
+
+        return stoichAn_O2, stoichAn_HCO3
+
+    def get_standard_gibbs_energies(self,
+                                    chemical_composition,
+                                    stoich_electron_donor,
+                                    stoich_cat_rxns,
+                                    stoich_anabolic_O2,
+                                    stoich_anabolic_HCO3):
+        '''the condition independent (standard) delta Gs of every compound'''
+        a = chemical_composition[:, 0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ne = stoich_electron_donor[:, 7]  # number of electrons transferred in D
+            nosc = -ne/a+4  # nominal oxidataion state of carbon
+            delGcox0PerC = 60.3-28.5*nosc  # kJ/C-mol
+            delGcox0 = delGcox0PerC*a*np.abs(stoich_electron_donor[:, 0])  # kJ/rxn
+
+            # - estimate delGf0 for electron donor
+            delGcox0_zero = stoich_electron_donor.dot(DELTA_GF0_ZERO)
+            delGf0_D_est = (delGcox0-delGcox0_zero)/stoich_electron_donor[:, 0]
+
+            # - standard delG at pH=0
+            delGcat0 = dot_delta_gf0(stoich_cat_rxns, delGf0_D_est)
+            delGan0_O2 = dot_delta_gf0(stoich_anabolic_O2, delGf0_D_est)
+            delGan0_HCO3 = dot_delta_gf0(stoich_anabolic_HCO3, delGf0_D_est)
+
+        return {'delGcox0PerC': delGcox0PerC, 'delGcox0': delGcox0, 'delGf0_D_est': delGf0_D_est,
+                'delGcat0': delGcat0, 'delGan0_O2': delGan0_O2, 'delGan0_HCO3': delGan0_HCO3}
+
+    def get_stoich_basis(self):
+        '''Steps 1 and 2 of get_all_thermo_stoich and the standard delta Gs:
+            everything that depends only on the compositions and the biomass
+            formula, as a ThermoStoichBasis
+        '''
+        # Step 1a) stoichiometries for an electron donor
+        self.stoich_electron_donor = self.get_stoich_electron_donor()
+
+        # Step 1b) stoichiometries for an electron acceptor (i.e., oxygen)
+        self.stoich_electron_acceptor = self.get_stoich_electron_acceptor()
+
+        # Step 1c) stoichCat: stoichiometries for catabolic reaciton
+        self.stoich_cat_rxns = \
+            self.get_stoich_catabolic_reaciton(self.stoich_electron_donor,
+                                               self.stoich_electron_acceptor)
+
+        # Step 2a) stoichAnStar: stoichiometries for anabolic reaciton
+        #          (N source = NH4+)
+        self.stoich_anabolic_O2, self.stoich_anabolic_HCO3 = \
+            self.get_stoich_anabolic_reaction(self.chemical_composition,
+                                              self.stoich_electron_donor,
+                                              self.stoich_electron_acceptor)
+
+        # - estimate delGcox0 using LaRowe and Van Cappellen (2011)
+        return ThermoStoichBasis(
+            self.stoich_electron_donor,
+            self.stoich_electron_acceptor,
+            self.stoich_cat_rxns,
+            self.stoich_anabolic_O2,
+            self.stoich_anabolic_HCO3,
+            **self.get_standard_gibbs_energies(self.chemical_composition,
+                                               self.stoich_electron_donor,
+                                               self.stoich_cat_rxns,
+                                               self.stoich_anabolic_O2,
+                                               self.stoich_anabolic_HCO3))
+
+    def get_lambda(self,
+                   chemical_composition,
+                   stoich_electron_donor,
+                   stoich_cat_rxns,
+                   stoich_anabolic_O2,
+                   stoich_anabolic_HCO3):
+        standard_gibbs_energies = self.get_standard_gibbs_energies(chemical_composition,
+                                                                   stoich_electron_donor,
+                                                                   stoich_cat_rxns,
+                                                                   stoich_anabolic_O2,
+                                                                   stoich_anabolic_HCO3)
+        basis = ThermoStoichBasis(stoich_electron_donor, None, stoich_cat_rxns,
+                                  stoich_anabolic_O2, stoich_anabolic_HCO3,
+                                  **standard_gibbs_energies)
+        return basis.energetics(*self.conditions())
+
+    def get_all_thermo_stoich(self):
+        '''same steps as ThermoStoichiometry.get_all_thermo_stoich, but every
+        result has one row per compound. Returns an (N, 83) array laid out as
+        the list returned by ThermoStoichiometry.get_all_thermo_stoich, or a
+        (K, N, 83) array for K conditions.
+        '''
+        # Steps 1-2: condition independent stoichiometries
+        basis = self.get_stoich_basis()
+
+        # Step 3: get lambda
+        (self.th_lambda, self.delta_gibbs_energy,
+         self.stoich_metabolic_O2, self.stoich_metabolic_HCO3) = \
+            basis.energetics(*self.conditions())
+
+        shape = self.th_lambda.shape[:-1]
+        return np.concatenate([np.broadcast_to(values, shape+values.shape[-1:]) for values in [
+            self.delta_gibbs_energy,
+            self.th_lambda,
+            self.stoich_electron_donor,
+            self.stoich_electron_acceptor,
+            self.stoich_cat_rxns,
+            self.stoich_anabolic_O2,
+            self.stoich_anabolic_HCO3,
+            self.stoich_metabolic_O2,
+            self.stoich_metabolic_HCO3]], axis=-1)
+
+
+class ThermoStoichBasis(object):
+    """condition independent part of the thermo stoichiometries
+
+    The donor, acceptor, catabolic and anabolic stoichiometries and the
+    standard delta Gs depend only on the compositions and the biomass formula.
+    energetics() adds the T/pH/eta/delGsyn dependent terms on top of them, so
+    new conditions cost a few whole-array products instead of a full
+    BatchThermoStoichiometry run.
+    """
+    def __init__(self,
+                 stoich_electron_donor,
+                 stoich_electron_acceptor,
+                 stoich_cat_rxns,
+                 stoich_anabolic_O2,
+                 stoich_anabolic_HCO3,
+                 delGcox0PerC,
+                 delGcox0,
+                 delGf0_D_est,
+                 delGcat0,
+                 delGan0_O2,
+                 delGan0_HCO3):
+        super(ThermoStoichBasis, self).__init__()
+        self.stoich_electron_donor = stoich_electron_donor
+        self.stoich_electron_acceptor = stoich_electron_acceptor
+        self.stoich_cat_rxns = stoich_cat_rxns
+        self.stoich_anabolic_O2 = stoich_anabolic_O2
+        self.stoich_anabolic_HCO3 = stoich_anabolic_HCO3
+        self.delGcox0PerC = delGcox0PerC
+        self.delGcox0 = delGcox0
+        self.delGf0_D_est = delGf0_D_est
+        self.delGcat0 = delGcat0
+        self.delGan0_O2 = delGan0_O2
+        self.delGan0_HCO3 = delGan0_HCO3
+
+    @classmethod
+    def from_tables(cls, results):
+        '''the basis held by a ThermoStoichTables (its stoichiometries and
+            standard delta Gs), without recomputing it
+        '''
+        stoich = {name: results.stoich[i] for i, name in enumerate(STOICH_NAMES)}
+        thermo = {name: results.thermo[:, i] for i, name in enumerate(THERMO_COLNAMES)}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delGf0_D_est = (thermo['delGcox0']-stoich['stoichD'].dot(DELTA_GF0_ZERO)) \
+                / stoich['stoichD'][:, 0]
+        return cls(stoich['stoichD'], stoich['stoichA'], stoich['stoichCat'],
+                   stoich['stoichAn_O2'], stoich['stoichAn_HCO3'],
+                   thermo['delGcox0PerC'], thermo['delGcox0'], delGf0_D_est,
+                   thermo['delGcat0'], thermo['delGan0_O2'], thermo['delGan0_HCO3'])
+
+    def reaction_energies(self, T, pH):
+        '''delGcox, delGcat, delGan_O2 and delGan_HCO3 at T and pH'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # - stadard delG at pH=7
+            log_h = np.log(10.0**-pH)
+            delGcox = self.delGcox0+R_GAS*T*self.stoich_electron_donor[:, I_PROTON]*log_h
+            delGcat = self.delGcat0+R_GAS*T*self.stoich_cat_rxns[:, I_PROTON]*log_h
+            delGan_O2 = self.delGan0_O2+R_GAS*T*self.stoich_anabolic_O2[:, I_PROTON]*log_h
+            delGan_HCO3 = self.delGan0_HCO3+R_GAS*T*self.stoich_anabolic_HCO3[:, I_PROTON]*log_h
+        return delGcox, delGcat, delGan_O2, delGan_HCO3
+
+    @staticmethod
+    def teem_lambda(delGcat, delGan, eta, delGsyn):
+        '''The Thermodynamic Electron Equivalents Model (TEEM)'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m = np.where(delGan < 0, 1, -1)
+            return (delGan*eta**m+delGsyn)/(-delGcat*eta)
+
+    def energetics(self, T, pH, eta, delGsyn):
+        '''lambda, delta Gs and metabolic stoichiometries under the given
+            conditions: floats, or (K, 1) arrays (see
+            BatchThermoStoichiometry.conditions) for a leading condition axis
+        '''
+        stoich_cat_rxns = self.stoich_cat_rxns
+        stoich_anabolic_O2 = self.stoich_anabolic_O2
+        stoich_anabolic_HCO3 = self.stoich_anabolic_HCO3
+
+        delGcox, delGcat, delGan_O2, delGan_HCO3 = self.reaction_energies(T, pH)
+        lambda_O2 = self.teem_lambda(delGcat, delGan_O2, eta, delGsyn)
+        lambda_HCO3 = self.teem_lambda(delGcat, delGan_HCO3, eta, delGsyn)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_h = np.log(10.0**-pH)
+            stoichMet_O2 = np.where((lambda_O2 > 0)[..., None],
+                                    lambda_O2[..., None]*stoich_cat_rxns+stoich_anabolic_O2,
+                                    stoich_anabolic_O2)
+            stoichMet_HCO3 = np.where((lambda_HCO3 > 0)[..., None],
+                                      lambda_HCO3[..., None]*stoich_cat_rxns+stoich_anabolic_HCO3,
+                                      stoich_anabolic_HCO3)
+
+            delGdis_O2 = dot_delta_gf0(stoichMet_O2, self.delGf0_D_est) \
+                + R_GAS*T*stoichMet_O2[..., I_PROTON]*log_h
+            delGdis_HCO3 = dot_delta_gf0(stoichMet_HCO3, self.delGf0_D_est) \
+                + R_GAS*T*stoichMet_HCO3[..., I_PROTON]*log_h
+
+        # the standard delta Gs do not depend on the conditions
+        shape = np.shape(lambda_O2)
+        delta_gibbs_energy = [self.delGcox0PerC, self.delGcox0, delGcox, self.delGcat0, delGcat,
+                              self.delGan0_O2, self.delGan0_HCO3, delGan_O2, delGan_HCO3,
+                              delGdis_O2, delGdis_HCO3]
+        return \
+            np.stack([lambda_O2, lambda_HCO3], axis=-1), \
+            np.stack([np.broadcast_to(delG, shape) for delG in delta_gibbs_energy], axis=-1), \
+            stoichMet_O2, \
+            stoichMet_HCO3
+
+
+def dot_delta_gf0(stoich, delGf0_D_est):
+    '''dot(delGf0, stoich) of (..., 10) stoichiometries: delGf0 only differs
+        by the electron donor, so it is one matrix-vector product plus the
+        donor column
+    '''
+    return stoich.dot(DELTA_GF0_ZERO)+delGf0_D_est*stoich[..., 0]
+
+
+# smallest number of compositions worth sending to a worker process
+MIN_SHARD_SIZE = 5000
+
+
+def compute_thermo_stoich_tables(chemical_composition, index=None, workers=None, model_params=None):
+    '''compute the ThermoStoichTables of an (N, 6) CHNOPS composition matrix
+        under a single set of model_params (keyword arguments of
+        BatchThermoStoichiometry). With workers > 1 the matrix is split into
+        contiguous shards that a process pool computes through shared memory.
+    '''
+    chemical_composition = np.ascontiguousarray(chemical_composition, dtype=np.float64)
+    model_params = model_params or {}
+    if BatchThermoStoichiometry(chemical_composition[:0],
+                                **model_params).num_conditions is not None:
+        raise ValueError('ThermoStoichTables hold a single set of conditions: {}'
+                         .format(model_params))
+    num_cpds = chemical_composition.shape[0]
+    if index is None:
+        index = pd.RangeIndex(num_cpds)
+
+    num_shards = min(workers or 1, num_cpds // MIN_SHARD_SIZE)
+    if num_shards <= 1:
+        results = ThermoStoichTables(index)
+        thermo_stoich = BatchThermoStoichiometry(chemical_composition, **model_params)
+        thermo_stoich.get_all_thermo_stoich()
+        results.fill(thermo_stoich)
+        return results
+
+    shapes = {
+        'composition': chemical_composition.shape,
+        'stoich': ThermoStoichTables.stoich_shape(num_cpds),
+        'thermo': ThermoStoichTables.thermo_shape(num_cpds),
+    }
+    shms = {}
+    try:
+        for name, shape in shapes.items():
+            shms[name] = SharedMemory(create=True, size=int(np.prod(shape))*8)
+        shm_names = {name: shm.name for name, shm in shms.items()}
+
+        shared_composition = np.ndarray(shapes['composition'], buffer=shms['composition'].buf)
+        shared_composition[:] = chemical_composition
+        del shared_composition
+
+        bounds = np.linspace(0, num_cpds, num_shards+1).astype(int)
+        with ProcessPoolExecutor(max_workers=num_shards) as executor:
+            futures = [executor.submit(_compute_shard, shm_names, num_cpds, start, stop,
+                                       model_params)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+        results = ThermoStoichTables(index)
+        results.stoich[:] = np.ndarray(shapes['stoich'], buffer=shms['stoich'].buf)
+        results.thermo[:] = np.ndarray(shapes['thermo'], buffer=shms['thermo'].buf)
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+    return results
+
+
+def _compute_shard(shm_names, num_cpds, start, stop, model_params):
+    '''worker of compute_thermo_stoich_tables: compute the rows start:stop
+        of the shared composition matrix into the shared result blocks
+    '''
+    shms = {name: SharedMemory(name=shm_name) for name, shm_name in shm_names.items()}
+    try:
+        chemical_composition = np.ndarray((num_cpds, len(CHEMICAL_ELEMENTS)),
+                                          buffer=shms['composition'].buf)
+        results = ThermoStoichTables(
+            pd.RangeIndex(num_cpds),
+            stoich=np.ndarray(ThermoStoichTables.stoich_shape(num_cpds), buffer=shms['stoich'].buf),
+            thermo=np.ndarray(ThermoStoichTables.thermo_shape(num_cpds), buffer=shms['thermo'].buf))
+        thermo_stoich = BatchThermoStoichiometry(chemical_composition[start:stop], **model_params)
+        thermo_stoich.get_all_thermo_stoich()
+        results.fill(thermo_stoich, slice(start, stop))
+        del chemical_composition, results, thermo_stoich
+    finally:
+        for shm in shms.values():
+            shm.close()
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing.shared_memory import SharedMemory
+from unittest import mock
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from ThermoStoichWizard.ThermoStoichiometry import (ThermoStoichiometry, BatchThermoStoichiometry,
+                                                    FTICRResult, LambdaBinIndex,
+                                                    CHEMICAL_ELEMENTS, MIN_SHARD_SIZE,
+                                                    compute_thermo_stoich_tables)
+from ThermoStoichWizard.ThermoStoichCache import ThermoStoichCache, open_cache
+from ThermoStoichWizard.LambdaUncertainty import LambdaUncertainty
+from ThermoStoichWizard.LambdaAnalysis import LambdaAnalysis
+from ThermoStoichWizard.BatchAnalysis import BatchAnalysis
+from ThermoStoichWizard.DistributionSketch import DistributionSketch, sketch_distances
+from ThermoStoichWizard.StreamingSummary import StreamingSummary
+
+# outputs of the per-formula implementation (68f0717) for golden/input.csv
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'golden')
+
+
+def _read_golden(name):
+    return pd.read_csv(os.path.join(GOLDEN_DIR, name), index_col=0,
+                       float_precision='round_trip')
+
+
+def _failing_shard(*args):
+    raise RuntimeError('shard failed')
+
+
+class ThermoStoichiometryTest(unittest.TestCase):
+    """offline tests of the thermodynamic core, no KBase services needed"""
+
+    def test_batch_thermo_stoich(self):
+        # the vectorized engine must reproduce the per-formula computation
+        compositions = np.array([
+            [10, 12, 0, 5, 0, 0],
+            [27, 15, 1, 6, 1, 1],
+            [6, 12, 0, 6, 0, 0],
+            [18, 30, 2, 9, 0, 1],
+        ])
+        batch = BatchThermoStoichiometry(compositions)
+        batch_result = batch.get_all_thermo_stoich()
+        for i, comp in enumerate(compositions):
+            thermo_stoich = ThermoStoichiometry(dict(zip(CHEMICAL_ELEMENTS, comp)))
+            expected = thermo_stoich.get_all_thermo_stoich()
+            np.testing.assert_allclose(batch_result[i], expected, rtol=1e-10)
+
+    def test_batch_thermo_conditions(self):
+        # arrays of conditions give one result per condition in a single pass
+        compositions = np.array([
+            [10, 12, 0, 5, 0, 0],
+            [27, 15, 1, 6, 1, 1],
+        ])
+        temperatures = np.array([288., 298., 310.])
+        pHs = np.array([6., 7., 8.])
+        batch_result = BatchThermoStoichiometry(compositions, T=temperatures,
+                                                pH=pHs).get_all_thermo_stoich()
+        self.assertEqual(batch_result.shape, (3, 2, 83))
+        for k, (T, pH) in enumerate(zip(temperatures, pHs)):
+            expected = BatchThermoStoichiometry(compositions, T=T, pH=pH).get_all_thermo_stoich()
+            np.testing.assert_allclose(batch_result[k], expected, rtol=1e-12)
+
+    def test_stoich_basis_energetics(self):
+        # new conditions on a precomputed basis match a full recomputation
+        compositions = np.array([
+            [10, 12, 0, 5, 0, 0],
+            [27, 15, 1, 6, 1, 1],
+        ])
+        basis = BatchThermoStoichiometry(compositions).get_stoich_basis()
+        th_lambda, delta_gibbs_energy, _, _ = basis.energetics(T=310., pH=6., eta=0.43,
+                                                               delGsyn=200.)
+        batch = BatchThermoStoichiometry(compositions, T=310, pH=6)
+        batch.get_all_thermo_stoich()
+        np.testing.assert_allclose(th_lambda, batch.th_lambda, rtol=1e-12)
+        np.testing.assert_allclose(delta_gibbs_energy, batch.delta_gibbs_energy, rtol=1e-12)
+
+    def test_lambda_uncertainty(self):
+        # two candidates for peak_a, one for peak_b
+        candidates = pd.DataFrame([
+            ['peak_a', 10, 12, 0, 5, 0, 0],
+            ['peak_a', 10, 14, 0, 5, 0, 0],
+            ['peak_b', 27, 15, 1, 6, 1, 1],
+        ], columns=['peak', 'C', 'H', 'N', 'O', 'P', 'S'])
+        lambda_uncertainty = LambdaUncertainty(candidates, peak_col='peak')
+        lambda_uncertainty.run(n_samples=50)
+        summary = lambda_uncertainty.peak_summary()
+        self.assertEqual(summary.num_candidates.tolist(), [2, 1])
+
+        batch = BatchThermoStoichiometry(candidates.iloc[:2, 1:].values.astype(float),
+                                         eta=lambda_uncertainty.samples.eta.values,
+                                         delGsyn=lambda_uncertainty.samples.delGsyn.values)
+        batch.get_all_thermo_stoich()
+        peak_a = batch.th_lambda[..., 0].ravel()
+        np.testing.assert_allclose(summary.loc['peak_a', 'lambda_mean'], peak_a.mean(), rtol=1e-12)
+        np.testing.assert_allclose(summary.loc['peak_a', 'lambda_std'], peak_a.std(ddof=1),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(summary.loc['peak_a', 'lambda_q50'], np.median(peak_a),
+                                   rtol=1e-12)
+        # without any uncertainty the bin averages do not move
+        fixed = LambdaUncertainty(candidates.iloc[1:], peak_col='peak')
+        fixed.run(n_samples=5, eta_sd=0, delGsyn_sd=0)
+        shifts = fixed.bin_shifts(n_bins=1, cutoff=0)
+        np.testing.assert_allclose(shifts['shift'], 0, atol=1e-12)
+        np.testing.assert_allclose(shifts['std'], 0, atol=1e-12)
+        with self.assertRaises(ValueError):
+            fixed.run(n_samples=1)
+
+    def test_run_samples(self):
+        # samples sharing compositions get the results of individual runs
+        columns = ['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na']
+        tbls = [
+            pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0],
+                          [27, 15, 1, 6, 1, 1, 0, 0]], columns=columns, index=['p1', 'p2']),
+            pd.DataFrame([[27, 15, 1, 6, 1, 1, 0, 0],
+                          [6, 12, 0, 6, 0, 0, 0, 0],
+                          [10, 12, 0, 5, 0, 0, 0, 0]], columns=columns, index=['p1', 'p2', 'p3']),
+        ]
+        samples = [FTICRResult(tbl.copy()) for tbl in tbls]
+        num_cpds, _, _ = FTICRResult.run_samples(samples)
+        self.assertEqual(num_cpds, 3)
+        for tbl, sample in zip(tbls, samples):
+            single = FTICRResult(tbl.copy())
+            single.run()
+            np.testing.assert_array_equal(sample.results.thermo, single.results.thermo)
+            np.testing.assert_array_equal(sample.results.stoich, single.results.stoich)
+
+    def test_sharded_run(self):
+        # shards computed by worker processes give the serial results bit for bit
+        rng = np.random.default_rng(0)
+        compositions = np.column_stack([rng.integers(1, 40, 3*MIN_SHARD_SIZE),
+                                        rng.integers(1, 60, (3*MIN_SHARD_SIZE, 3)),
+                                        rng.integers(0, 2, (3*MIN_SHARD_SIZE, 2))])
+        serial = compute_thermo_stoich_tables(compositions)
+        sharded = compute_thermo_stoich_tables(compositions, workers=3)
+        np.testing.assert_array_equal(sharded.thermo, serial.thermo)
+        np.testing.assert_array_equal(sharded.stoich, serial.stoich)
+
+    def test_sharded_run_failure(self):
+        # the shared memory is released when a shard raises
+        created = []
+
+        def recording_shared_memory(*args, **kwargs):
+            shm = SharedMemory(*args, **kwargs)
+            if kwargs.get('create'):
+                created.append(shm.name)
+            return shm
+
+        compositions = np.tile([[10, 12, 0, 5, 0, 0]], (2*MIN_SHARD_SIZE, 1))
+        with mock.patch('ThermoStoichWizard.ThermoStoichiometry.SharedMemory',
+                        recording_shared_memory), \
+                mock.patch('ThermoStoichWizard.ThermoStoichiometry._compute_shard',
+                           _failing_shard):
+            with self.assertRaises(RuntimeError):
+                compute_thermo_stoich_tables(compositions, workers=2)
+        self.assertEqual(len(created), 3)
+        for name in created:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
+
+    @unittest.skipIf(pyarrow is None, 'parquet and feather need pyarrow')
+    def test_save_result_formats(self):
+        # parquet and feather tables read back as the csv ones
+        tbl = pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0],
+                            [27, 15, 1, 6, 1, 1, 0, 0]],
+                           columns=['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na'])
+        fticr = FTICRResult(tbl)
+        fticr.run()
+        tables = ['stoichMet_O2', 'thermodynamic_props', 'stoich_matrices']
+        folder = tempfile.mkdtemp()
+        try:
+            paths = fticr.save_result_files(folder, fmt='csv', tables=tables)
+            expected = {name: pd.read_csv(path, float_precision='round_trip')
+                        for name, path in paths.items()}
+            for fmt, read in [('parquet', pd.read_parquet), ('feather', pd.read_feather)]:
+                paths = fticr.save_result_files(folder, fmt=fmt, tables=tables)
+                for name, path in paths.items():
+                    df = read(path)
+                    if name == 'stoich_matrices':
+                        df['matrix'] = df['matrix'].astype(str)
+                    elif fmt == 'parquet':
+                        # feather stores the index as a column already
+                        df = df.reset_index()
+                    df.columns = expected[name].columns
+                    pd.testing.assert_frame_equal(df, expected[name])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_correlation_grid(self):
+        # every cell of a non-square grid matches np.corrcoef, whatever the block size
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'lambda_O2': rng.uniform(0, 0.3, 40),
+                           'donor': -rng.uniform(0.5, 2, 40),
+                           'acceptor': -rng.uniform(0.5, 2, 40),
+                           'hco3': rng.uniform(0, 1, 40)})
+        vh_cs = [0.5, 1., 2.]
+        vh_o2 = [0.1, 10.]
+        expected = {name: np.zeros((2, 3)) for name in ['r_lambda_rbiom', 'r_lambda_ro2',
+                                                        'r_lambda_rhco3']}
+        for i, j in np.ndindex(2, 3):
+            r_biom = np.exp(-np.abs(df.donor)/vh_cs[j])*np.exp(-np.abs(df.acceptor)/vh_o2[i])
+            for name, rate in [('r_lambda_rbiom', r_biom),
+                               ('r_lambda_ro2', np.abs(df.acceptor)*r_biom),
+                               ('r_lambda_rhco3', np.abs(df.hco3)*r_biom)]:
+                expected[name][i, j] = np.corrcoef(df.lambda_O2, rate)[0, 1]
+        analysis = LambdaAnalysis.__new__(LambdaAnalysis)
+        for max_elements in [1, 240, 2**24]:
+            corr_mats = analysis._correlation_grid(df, vh_cs, vh_o2, max_elements=max_elements)
+            for name in expected:
+                np.testing.assert_allclose(corr_mats[name], expected[name], rtol=1e-10)
+
+    def test_golden_reactions(self):
+        # the reaction file of the golden stoichiometries is the old one byte
+        # for byte, the engine agrees with the old numbers up to rounding
+        fticr = FTICRResult(pd.read_csv(os.path.join(GOLDEN_DIR, 'input.csv'), index_col=0))
+        fticr.run()
+        for name, df in [('thermodynamic_props.csv', fticr.thermo),
+                         ('stoichMet_O2.csv', fticr.stoichMet_O2)]:
+            expected = _read_golden(name)
+            self.assertEqual(df.index.tolist(), expected.index.tolist())
+            np.testing.assert_allclose(df.values, expected.values, rtol=1e-10, atol=1e-12)
+        folder = tempfile.mkdtemp()
+        try:
+            fout = os.path.join(folder, 'temp_stoichMet_O2.tsv')
+            fticr.create_rxn_file_fba_model(_read_golden('stoichMet_O2.csv'), fout)
+            with open(fout, 'rb') as f, \
+                    open(os.path.join(GOLDEN_DIR, 'temp_stoichMet_O2.tsv'), 'rb') as golden:
+                self.assertEqual(f.read(), golden.read())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_golden_compounds_media(self):
+        # compound and media files are the old ones byte for byte
+        fticr = FTICRResult(pd.read_csv(os.path.join(GOLDEN_DIR, 'input.csv'), index_col=0))
+        folder = tempfile.mkdtemp()
+        try:
+            fticr.create_cpd_file_fba_model(os.path.join(folder, 'temp_comps.tsv'))
+            fticr.create_media_file(os.path.join(folder, 'temp_media.tsv'))
+            for name in ['temp_comps.tsv', 'temp_media.tsv']:
+                with open(os.path.join(folder, name), 'rb') as f, \
+                        open(os.path.join(GOLDEN_DIR, name), 'rb') as golden:
+                    self.assertEqual(f.read(), golden.read(), name)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_golden_bin_avg(self):
+        # from_compositions on the bin averages gives the files of the old
+        # FTICRResult(new_comp, dtype=float).run() path
+        fticr = FTICRResult(pd.read_csv(os.path.join(GOLDEN_DIR, 'input.csv'), index_col=0))
+        fticr.run()
+        average_comp = _read_golden('average_comp.csv')
+        new_comp = fticr.average_by_lambda_bins(n_bins=4, cutoff=5)
+        np.testing.assert_allclose(new_comp[average_comp.columns[1:]].values.astype(float),
+                                   average_comp[average_comp.columns[1:]].values, rtol=1e-10)
+
+        bin_avg = FTICRResult.from_compositions(average_comp)
+        for name, df in [('bin_avg_thermodynamic_props.csv', bin_avg.thermo),
+                         ('bin_avg_stoichMet_O2.csv', bin_avg.stoichMet_O2)]:
+            expected = _read_golden(name)
+            self.assertEqual(df.index.tolist(), expected.index.tolist())
+            np.testing.assert_allclose(df.values, expected.values, rtol=1e-10, atol=1e-12)
+        folder = tempfile.mkdtemp()
+        try:
+            bin_avg.create_cpd_file_fba_model(os.path.join(folder, 'bin_avg_comps.tsv'))
+            bin_avg.create_rxn_file_fba_model(_read_golden('bin_avg_stoichMet_O2.csv'),
+                                              os.path.join(folder, 'bin_avg_stoichMet_O2.tsv'))
+            for name in ['bin_avg_comps.tsv', 'bin_avg_stoichMet_O2.tsv']:
+                with open(os.path.join(folder, name), 'rb') as f, \
+                        open(os.path.join(GOLDEN_DIR, name), 'rb') as golden:
+                    self.assertEqual(f.read(), golden.read(), name)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_pooled_lambda_bins(self):
+        # edges over the compounds of the union, shared ones counted once
+        columns = ['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na']
+        tbls = [pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0],
+                              [27, 15, 1, 6, 1, 1, 0, 0]], columns=columns),
+                pd.DataFrame([[27, 15, 1, 6, 1, 1, 0, 0],
+                              [6, 12, 0, 6, 0, 0, 0, 0],
+                              [18, 30, 2, 9, 0, 1, 0, 0]], columns=columns)]
+        samples = [FTICRResult(tbl) for tbl in tbls]
+        FTICRResult.run_samples(samples)
+        union_lambda = pd.concat([s.thermo for s in samples]).groupby(level=0).lambda_O2.first()
+        bins = BatchAnalysis._pooled_lambda_bins(samples, 2, 10, 'cumulative')
+        np.testing.assert_allclose(bins, np.percentile(union_lambda, [10, 50, 90]), rtol=1e-12)
+
+    def test_distribution_sketches(self):
+        edges = np.linspace(0, 1, 11)
+        rng = np.random.default_rng(0)
+        a = rng.uniform(0, 0.5, 1000)
+        b = rng.uniform(0.5, 1, 1000)
+        sketch_a = DistributionSketch.from_values(a, edges)
+        sketch_b = DistributionSketch.from_values(b, edges)
+        # merging is exact
+        merged = sketch_a.merge(sketch_b)
+        self.assertEqual(merged.to_dict(),
+                         DistributionSketch.from_values(np.concatenate([a, b]), edges).to_dict())
+        # disjoint halves of [0, 1]: KS 1 and Wasserstein 0.5
+        ks = sketch_distances([sketch_a, sketch_b], metric='ks')
+        wasserstein = sketch_distances([sketch_a, sketch_b], metric='wasserstein')
+        np.testing.assert_allclose(ks, [[0, 1], [1, 0]])
+        np.testing.assert_allclose(wasserstein, [[0, 0.5], [0.5, 0]], atol=0.02)
+
+    def test_streaming_summary(self):
+        values = np.random.default_rng(0).lognormal(-3, 0.6, 100000)
+        # shards summarized separately and merged
+        summary = StreamingSummary()
+        for shard in np.array_split(values, 7):
+            summary.merge(StreamingSummary().update(shard))
+        self.assertEqual(summary.count, values.size)
+        np.testing.assert_allclose(summary.mean, values.mean(), rtol=1e-12)
+        np.testing.assert_allclose(summary.std(), values.std(ddof=1), rtol=1e-9)
+        q = [0.01, 0.5, 0.99]
+        ranks = np.searchsorted(np.sort(values), summary.quantile(q)) / values.size
+        np.testing.assert_allclose(ranks, q, atol=1e-3)
+
+    def test_lazy_streaming_summary(self):
+        # summaries are streamed only for exact=False, and again after set_conditions
+        tbl = pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0],
+                            [27, 15, 1, 6, 1, 1, 0, 0],
+                            [6, 12, 0, 6, 0, 0, 0, 0]],
+                           columns=['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na'])
+        fticr = FTICRResult(tbl)
+        fticr.run()
+        fticr.get_summary('lambda_O2')
+        self.assertEqual(fticr.results.summaries, {})
+        np.testing.assert_allclose(fticr.get_summary('lambda_O2', exact=False)[:2],
+                                   fticr.get_summary('lambda_O2')[:2], rtol=1e-12)
+        self.assertEqual(list(fticr.results.summaries), ['lambda_O2'])
+        fticr.set_conditions(T=310.)
+        self.assertEqual(fticr.results.summaries, {})
+        np.testing.assert_allclose(fticr.get_summary('lambda_O2', exact=False)[0],
+                                   fticr.thermo.lambda_O2.mean(), rtol=1e-12)
+
+    def test_stratified_sample(self):
+        # every class keeps its share of the points and at least one point
+        labels = np.array(['Lignin']*900 + ['Lipid']*95 + ['Tannin']*5, dtype=object)
+        rows = FTICRResult._stratified_sample(labels, 100)
+        counts = pd.Series(labels[rows]).value_counts()
+        self.assertEqual(counts.to_dict(), {'Lignin': 90, 'Lipid': 9, 'Tannin': 1})
+        self.assertTrue(np.all(np.diff(rows) > 0))
+
+    def test_van_krevelen_limits(self):
+        # limits cover every finite ratio, the defaults stay without any
+        limits = FTICRResult._axis_limits(np.array([0.2, np.nan, 1.2, np.inf]))
+        np.testing.assert_allclose(limits, (0.15, 1.25))
+        self.assertIsNone(FTICRResult._axis_limits(np.array([np.nan, np.inf])))
+        tbl = pd.DataFrame([[0, 2, 1, 0, 0, 1, 0, 0, 'Other'],
+                            [0, 4, 0, 0, 1, 1, 0, 0, 'Other']],
+                           columns=['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na', 'Class'])
+        folder = tempfile.mkdtemp()
+        try:
+            ax = FTICRResult(tbl).plot_van_krevelen(os.path.join(folder, 'vk.png'))
+            self.assertEqual(ax.get_xlim(), (0, 1))
+        finally:
+            shutil.rmtree(folder)
+            plt.close('all')
+
+    def test_thermo_stoich_cache(self):
+        # a second run is served from the cache with the same results
+        tbl = pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0],
+                            [27, 15, 1, 6, 1, 1, 0, 0]],
+                           columns=['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na'])
+        folder = tempfile.mkdtemp()
+        try:
+            with ThermoStoichCache(os.path.join(folder, 'cache.sqlite')) as cache:
+                first = FTICRResult(tbl.copy())
+                first.run(cache=cache)
+                second = FTICRResult(tbl.copy())
+                second.run(cache=cache)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual((first.cache_hits, first.cache_misses), (0, 2))
+        self.assertEqual((second.cache_hits, second.cache_misses), (2, 0))
+        np.testing.assert_array_equal(first.results.thermo, second.results.thermo)
+
+    def test_open_cache(self):
+        # off without a configured path, reused by later jobs with one
+        with open_cache({'scratch': '/kb/module/work/tmp'}) as cache:
+            self.assertIsNone(cache)
+        tbl = pd.DataFrame([[10, 12, 0, 5, 0, 0, 0, 0]],
+                           columns=['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na'])
+        folder = tempfile.mkdtemp()
+        config = {'thermo-cache-path': os.path.join(folder, 'cache.sqlite'),
+                  'thermo-cache-max-entries': '10'}
+        try:
+            for _ in range(2):
+                fticr = FTICRResult(tbl.copy())
+                with open_cache(config) as cache:
+                    fticr.run(cache=cache)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual((fticr.cache_hits, fticr.cache_misses), (1, 0))
+
+    def test_lambda_bin_index(self):
+        # percentiles match np.percentile, averages over right-closed bins match pd.cut
+        rng = np.random.default_rng(0)
+        cpd_lambda = rng.uniform(0, 0.3, 50)
+        cpd_index = rng.integers(0, 50, 200)
+        peak_comp = rng.integers(0, 30, (200, 6))
+        bin_index = LambdaBinIndex(cpd_lambda, cpd_index, peak_comp)
+        bins = bin_index.percentile(np.linspace(5, 95, 5))
+        np.testing.assert_allclose(bins, np.percentile(cpd_lambda, np.linspace(5, 95, 5)),
+                                   rtol=1e-12)
+        peaks = pd.DataFrame(np.column_stack([peak_comp, cpd_lambda[cpd_index]]))
+        expected = peaks.groupby(pd.cut(peaks[6], bins), observed=False).mean()
+        np.testing.assert_allclose(bin_index.average(bins), expected.values, rtol=1e-12)
+
+    def test_lambda_bins_duplicated_peaks(self):
+        # edges over the unique compositions, counts over every assigned peak
+        columns = ['C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na']
+        compositions = [[10, 12, 0, 5, 0, 0], [27, 15, 1, 6, 1, 1], [6, 12, 0, 6, 0, 0],
+                        [18, 30, 2, 9, 0, 1], [12, 20, 0, 8, 0, 0]]
+        rows = [compositions[i] + [0, 0] for i in [0, 1, 1, 1, 2, 3, 4, 4]]
+        fticr = FTICRResult(pd.DataFrame(rows, columns=columns))
+        fticr.run()
+        self.assertEqual(fticr.thermo.shape[0], 5)
+        self.assertEqual(len(fticr.id2mf), 8)
+        self.assertEqual(fticr.mf2id[fticr.id2mf['xcpd__1']], 'xcpd__3')
+
+        cpd_lambda = fticr.thermo.lambda_O2.values
+        bins = fticr._cumulative_lambda_bins(2, 10)
+        np.testing.assert_allclose(bins, np.percentile(cpd_lambda, [10, 50, 90]), rtol=1e-12)
+        peak_lambda = fticr.peak_thermo().lambda_O2
+        expected = peak_lambda.groupby(pd.cut(peak_lambda, bins), observed=False).size()
+        np.testing.assert_array_equal(fticr.lambda_bin_index.counts(bins), expected.values)
+        self.assertEqual(fticr.lambda_bin_index.counts([0, fticr.lambda_bin_index.max()]), [8])
+
+    def test_from_attribute_mapping(self):
+        # chunks smaller than the table lose no peaks, other attributes are kept
+        attributes = ['mass', 'C', 'H', 'N', 'O', 'P', 'S', 'C13', 'Na', 'Class']
+        rows = [['200.1', '10', '12', '0', '5', '0', '0', '0', '0', 'Lignin'],
+                ['500.2', '27', '15', '1', '6', '1', '1', '0', '0', 'Protein'],
+                ['180.1', '6', '12', '0', '6', '0', '0', '0', '0', 'Carbohydrate'],
+                ['181.1', '6', '12', '0', '6', '0', '0', '1', '0', 'Carbohydrate'],
+                ['410.3', '18', '30', '2', '9', '0', '1', '0', '0', 'Lipid']]
+        data = {'attributes': [{'attribute': a} for a in attributes],
+                'instances': {'peak{}'.format(i): row for i, row in enumerate(rows)}}
+        whole = FTICRResult.from_attribute_mapping(data)
+        for chunk_size in [1, 2, 4]:
+            chunked = FTICRResult.from_attribute_mapping(data, chunk_size=chunk_size)
+            pd.testing.assert_frame_equal(chunked._assigned_tbl, whole._assigned_tbl)
+        tbl = whole._assigned_tbl
+        self.assertEqual(tbl.shape[0], 4)
+        self.assertEqual(tbl.Class.tolist(), ['Lignin', 'Protein', 'Carbohydrate', 'Lipid'])
+        self.assertEqual(tbl.mass.tolist(), ['200.1', '500.2', '180.1', '410.3'])
+        self.assertEqual(tbl.C.tolist(), [10, 27, 6, 18])
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+'''
+Offline benchmark of the thermodynamic core on synthetic Formularity tables
+
+Every stage of the FTICRResult pipeline is timed separately for each table
+size and the timings are written to a JSON file, so releases can be compared
+against each other. No KBase services are needed:
+
+    python test/benchmark_thermo_stoich.py --out benchmark.json
+    python test/benchmark_thermo_stoich.py --sizes 1000 10000 --repeat 3
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from ThermoStoichWizard.ThermoStoichiometry import FTICRResult, CHEMICAL_ELEMENTS  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+STAGES = ['init', 'run', 'save_result_files', 'create_fba_model_files',
+          'average_by_lambda_bins', 'average_by_lambda_bins_uniform',
+          'plot_lambda_dist', 'plot_delta_gibb_dist', 'plot_van_krevelen']
+
+# monoisotopic masses of C, H, N, O, P, S, 13C-12C and Na-H
+MONOISOTOPIC_MASS = np.array([12.0, 1.007825, 14.003074, 15.994915, 30.973762, 31.972071])
+C13_SHIFT = 1.003355
+NA_SHIFT = 21.981944
+
+
+def compound_class(hc, oc, n, s, p):
+    '''van Krevelen compound classes from the H:C and O:C ratios'''
+    conditions = [
+        (hc >= 1.5) & (hc <= 2.0) & (oc <= 0.3),
+        (hc >= 1.5) & (hc <= 2.2) & (oc > 0.3) & (oc <= 0.67) & (n > 0),
+        (hc >= 1.5) & (hc <= 2.4) & (oc > 0.67) & (oc <= 1.2),
+        (hc >= 0.7) & (hc < 1.5) & (oc > 0.1) & (oc <= 0.67),
+        (hc >= 0.5) & (hc < 1.5) & (oc > 0.67) & (oc <= 1.0),
+        (hc >= 0.2) & (hc < 0.7) & (oc <= 0.67),
+        (hc >= 1.5) & (oc <= 0.3) & ((s > 0) | (p > 0)),
+    ]
+    classes = ['Lipid', 'Protein', 'Amino Sugar', 'Lignin', 'Tannin', 'Cond Hydrocarbon',
+               'Unsat Hydrocarbon']
+    return np.select(conditions, classes, default='Other')
+
+
+def synthetic_formularity_table(num_peaks, seed=0, unassigned=0.3, isotopes=0.1, sodium=0.03):
+    '''a Formularity-style peak table: CHNOPS, C13, Na, Class and Mass.
+        A fraction of the peaks is unassigned (all elements zero) and some
+        assigned peaks are 13C or Na adducts of another peak's composition.
+    '''
+    rng = np.random.default_rng(seed)
+    c = rng.integers(4, 50, num_peaks)
+    h = np.maximum(np.rint(c * rng.uniform(0.3, 2.2, num_peaks)), 1).astype(int)
+    o = np.rint(c * rng.beta(2, 4, num_peaks) * 1.2).astype(int)
+    n = rng.choice(4, num_peaks, p=[0.6, 0.25, 0.1, 0.05])
+    p = (rng.random(num_peaks) < 0.05).astype(int)
+    s = (rng.random(num_peaks) < 0.1).astype(int)
+    comp = np.column_stack([c, h, n, o, p, s])
+
+    # adducts repeat the composition of another peak
+    C13 = (rng.random(num_peaks) < isotopes).astype(int)
+    Na = (~C13.astype(bool) & (rng.random(num_peaks) < sodium)).astype(int)
+    adducts = np.flatnonzero(C13 | Na)
+    comp[adducts] = comp[rng.integers(0, num_peaks, adducts.size)]
+    mass = comp @ MONOISOTOPIC_MASS + C13 * C13_SHIFT + Na * NA_SHIFT
+
+    comp[rng.random(num_peaks) < unassigned] = 0
+    c, h, n, o, p, s = comp.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        classes = compound_class(h / c, o / c, n, s, p)
+    classes[c == 0] = 'Unassigned'
+
+    tbl = pd.DataFrame({'Mass': mass, 'C': c, 'H': h, 'O': o, 'N': n, 'C13': C13,
+                        'S': s, 'P': p, 'Na': Na, 'Class': classes})
+    tbl.index = ['peak_{}'.format(i) for i in range(num_peaks)]
+    return tbl[['Mass'] + CHEMICAL_ELEMENTS + ['C13', 'Na', 'Class']]
+
+
+def timed(func, *args, **kwargs):
+    '''wall clock seconds of func(*args, **kwargs) and its return value'''
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+
+def benchmark_size(num_peaks, workdir, workers=None, output_format='csv', n_bins=10, cutoff=5):
+    '''time every stage once for a table of num_peaks rows'''
+    tbl = synthetic_formularity_table(num_peaks)
+    timings = {}
+
+    timings['init'], fticr = timed(FTICRResult, tbl)
+    timings['run'], _ = timed(fticr.run, workers=workers)
+
+    folder = tempfile.mkdtemp(dir=workdir)
+    timings['save_result_files'], _ = timed(fticr.save_result_files, folder, fmt=output_format,
+                                            tables=["stoichMet_O2", "thermodynamic_props",
+                                                    "stoich_matrices"])
+    timings['create_fba_model_files'], _ = timed(fticr.create_fba_model_files, folder)
+
+    timings['average_by_lambda_bins'], _ = timed(fticr.average_by_lambda_bins,
+                                                 n_bins=n_bins, cutoff=cutoff)
+    timings['average_by_lambda_bins_uniform'], _ = timed(fticr.average_by_lambda_bins_uniform,
+                                                         n_bins=n_bins, cutoff=cutoff)
+
+    timings['plot_lambda_dist'], _ = timed(fticr.plot_lambda_dist,
+                                           fout=os.path.join(folder, 'lambda_dist.png'))
+    timings['plot_delta_gibb_dist'], _ = timed(fticr.plot_delta_gibb_dist, 'delGcox0PerC',
+                                               r'$\Delta G_{Cox}^0$',
+                                               os.path.join(folder, 'delGcox0_dist.png'))
+    timings['plot_van_krevelen'], _ = timed(fticr.plot_van_krevelen,
+                                            os.path.join(folder, 'van_krevelen.png'))
+    matplotlib.pyplot.close('all')
+
+    shutil.rmtree(folder)
+    return {'num_peaks': num_peaks, 'num_cpds': fticr.num_cpds, 'timings': timings}
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, repeat=1, workers=None, output_format='csv'):
+    '''best of repeat timings of every stage for each table size'''
+    workdir = tempfile.mkdtemp(prefix='thermo_stoich_benchmark_')
+    results = []
+    try:
+        for num_peaks in sizes:
+            runs = [benchmark_size(num_peaks, workdir, workers=workers, output_format=output_format)
+                    for _ in range(repeat)]
+            best = {stage: min(r['timings'][stage] for r in runs) for stage in STAGES}
+            results.append({'num_peaks': num_peaks, 'num_cpds': runs[0]['num_cpds'],
+                            'repeat': repeat, 'seconds': best})
+            print('{:>8} peaks: {}'.format(num_peaks, ', '.join(
+                '{} {:.3f}s'.format(stage, best[stage]) for stage in STAGES)))
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': workers,
+        'output_format': output_format,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='table sizes (rows)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per size, the best time is kept')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes used by FTICRResult.run')
+    parser.add_argument('--format', default='csv', help='output format of save_result_files')
+    parser.add_argument('--out', default='benchmark_thermo_stoich.json',
+                        help='JSON file of the timings')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.sizes, repeat=args.repeat, workers=args.workers,
+                           output_format=args.format)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('timings written to', args.out)
+
+
+if __name__ == '__main__':
+    main()